@@ -0,0 +1,150 @@
+'''
+Builds two plotly charts for a result frame from its schema and cardinality, without asking the LLM
+'''
+import re
+
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+# Column names that mark a numeric column as an identifier rather than a measure
+ID_NAME = re.compile(r'(^|_)(ID|KEY|CODE|ZIP|PHONE)$|^ID', re.IGNORECASE)
+# Column names that mark text or integer columns as dates
+TIME_NAME = re.compile(r'DATE|TIME|DAY|WEEK|MONTH|QUARTER|YEAR|PERIOD|_AT$|_DT$', re.IGNORECASE)
+
+MAX_CATEGORIES = 50  # Distinct values above which a text column is not a category
+MAX_COLOURS = 10  # Distinct values above which a category is not used for colour
+MAX_BARS = 20
+MAX_POINTS = 5000
+TABLE_ROWS = 20
+
+
+def _asTime(values):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    if pd.api.types.is_integer_dtype(values) and TIME_NAME.search(str(values.name)) \
+            and values.dropna().between(1900, 2100).all():
+        return pd.to_datetime(values.astype("Int64").astype(str), format="%Y", errors="coerce")
+    if (pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)) \
+            and TIME_NAME.search(str(values.name)):
+        parsed = pd.to_datetime(values, errors="coerce")
+        if parsed.notna().mean() >= 0.8:
+            return parsed
+    return None
+
+
+def classifyColumns(df):
+    '''
+    Returns (times, measures, categories, df): the column names of each kind, in column order, and a copy of df
+    with its time columns converted to datetimes
+    '''
+    df = df.copy()
+    times, measures, categories = [], [], []
+    for column in df.columns:
+        values = df[column]
+        as_time = _asTime(values)
+        if as_time is not None:
+            df[column] = as_time
+            times.append(column)
+        elif pd.api.types.is_bool_dtype(values):
+            categories.append(column)
+        elif pd.api.types.is_numeric_dtype(values):
+            is_id = ID_NAME.search(str(column)) and values.nunique() > 0.9 * len(values)
+            if not is_id:
+                measures.append(column)
+        else:
+            try:
+                distinct = values.nunique()
+            except TypeError:  # Unhashable cells
+                continue
+            if distinct <= MAX_CATEGORIES or distinct <= 0.5 * len(values):
+                categories.append(column)
+    return times, measures, categories, df
+
+
+def _colour(df, categories, exclude=None):
+    for column in categories:
+        if column != exclude and 1 < df[column].nunique() <= MAX_COLOURS:
+            return column
+    return None
+
+
+def _lineChart(df, time, measures, categories):
+    colour = _colour(df, categories)
+    if colour:
+        data = df.groupby([time, colour], observed=True, as_index=False)[measures[0]].sum().sort_values(time)
+        return px.line(data, x=time, y=measures[0], color=colour, markers=len(data) <= 60,
+                       title=f"{measures[0]} over {time} by {colour}")
+    data = df.groupby(time, as_index=False)[measures[:3]].sum().sort_values(time)
+    return px.line(data, x=time, y=measures[:3], markers=len(data) <= 60,
+                   title=f"{', '.join(measures[:3])} over {time}")
+
+
+def _barChart(df, category, measure):
+    data = df.groupby(category, observed=True, as_index=False)[measure].sum()
+    data = data.sort_values(measure, ascending=False).head(MAX_BARS)
+    data[category] = data[category].astype(str)
+    title = f"{measure} by {category}" + (f" (top {MAX_BARS})" if df[category].nunique() > MAX_BARS else "")
+    return px.bar(data, x=category, y=measure, title=title)
+
+
+def _scatterChart(df, x, y, categories):
+    data = df.sample(MAX_POINTS, random_state=0) if len(df) > MAX_POINTS else df
+    colour = _colour(data, categories)
+    return px.scatter(data, x=x, y=y, color=colour, title=f"{y} vs {x}")
+
+
+def _histogram(df, measure):
+    data = df.sample(MAX_POINTS, random_state=0) if len(df) > MAX_POINTS else df
+    return px.histogram(data, x=measure, title=f"Distribution of {measure}")
+
+
+def _countChart(df, category):
+    data = df[category].astype(str).value_counts().head(MAX_BARS).rename_axis(category).reset_index(name="Rows")
+    return px.bar(data, x=category, y="Rows", title=f"Rows by {category}")
+
+
+def _tableChart(df):
+    shown = df.head(TABLE_ROWS)
+    return go.Figure(data=[go.Table(
+        header={"values": [str(column) for column in shown.columns]},
+        cells={"values": [shown[column].astype(str).tolist() for column in shown.columns]},
+    )], layout={"title": {"text": f"First {len(shown)} of {len(df)} rows"}})
+
+
+def recommendCharts(df):
+    '''
+    Two plotly figures for df, picked in order from: measures over time, a measure by category, a scatter of two
+    measures, a histogram, row counts by category, and a table of the first rows; (None, None) when df has no rows
+    '''
+    if df is None or not isinstance(df, pd.DataFrame) or df.empty:
+        return None, None
+    times, measures, categories, df = classifyColumns(df)
+
+    builders = []
+    if times and measures:
+        builders.append(lambda: _lineChart(df, times[0], measures, categories))
+    if categories and measures:
+        builders.append(lambda: _barChart(df, categories[0], measures[0]))
+        if len(measures) > 1:
+            builders.append(lambda: _barChart(df, categories[0], measures[1]))
+    if len(measures) > 1:
+        builders.append(lambda: _scatterChart(df, measures[0], measures[1], categories))
+    if times and len(measures) > 1:
+        builders.append(lambda: _lineChart(df, times[0], measures[1:], categories))
+    if measures:
+        builders.append(lambda: _histogram(df, measures[0]))
+    if categories:
+        builders.append(lambda: _countChart(df, categories[0]))
+
+    figures = []
+    for build in builders:
+        try:
+            figures.append(build())
+        except (ValueError, TypeError, KeyError) as e:
+            print(f"Skipping a rule-based chart: {e}")
+        if len(figures) == 2:
+            break
+    while len(figures) < 2:
+        figures.append(_tableChart(df))
+    return figures[0], figures[1]
@@ -0,0 +1,425 @@
+'''
+Runs LLM-generated code in pre-warmed worker processes, with CPU, wall-clock and memory limits
+'''
+import ast
+import hashlib
+import importlib
+import marshal
+import multiprocessing
+import os
+import queue
+import signal
+import tempfile
+import textwrap
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+
+import pyarrow as pa
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; CPU and address-space limits are then not enforced
+    resource = None
+
+# Modules every worker imports before it is handed any code
+WARM_IMPORTS = ["numpy", "pandas", "plotly.express", "plotly.graph_objects", "plotly.io", "statsmodels.api"]
+
+# Filename given to generated code, so errors can point at its lines only
+GENERATED_FILENAME = "<generated code>"
+
+# Top-level modules generated code may not import
+BANNED_IMPORTS = frozenset({
+    "builtins", "ctypes", "http", "importlib", "multiprocessing", "os", "pickle", "requests", "shutil", "signal",
+    "socket", "subprocess", "sys", "urllib",
+})
+
+# Functions each worker keeps resolved, most recently used last
+WORKER_FUNCTION_CACHE_SIZE = 64
+
+# Where DataFrames are exchanged between processes
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class SandboxError(Exception):
+    '''The generated code raised, or its worker died or was killed'''
+
+
+class SandboxTimeout(SandboxError):
+    '''The generated code ran past its wall-clock or CPU-time limit'''
+
+
+class SandboxMemoryError(SandboxError):
+    '''The generated code went over the resident memory limit'''
+
+
+class CodeValidationError(SandboxError):
+    '''The generated code was rejected before it ran'''
+
+
+def normalizeCode(code):
+    '''
+    Generated code without markdown fences, common indentation, trailing whitespace or surrounding blank lines
+    '''
+    code = textwrap.dedent(code.replace("```python", "").replace("```", ""))
+    return "\n".join(line.rstrip() for line in code.splitlines()).strip("\n") + "\n"
+
+
+def codeHash(code, function):
+    return hashlib.sha256(f"{function}\0{code}".encode()).hexdigest()
+
+
+def compileCode(code, function, banned_imports=BANNED_IMPORTS):
+    '''
+    Checks that code parses, defines function at the top level and imports no banned module, and returns its
+    code object. Raises CodeValidationError otherwise.
+    '''
+    try:
+        tree = ast.parse(code, GENERATED_FILENAME)
+    except SyntaxError as e:
+        raise CodeValidationError(f"SyntaxError: {e.msg} (line {e.lineno})") from None
+    if not any(isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == function
+               for node in tree.body):
+        raise CodeValidationError(f"The code did not define a '{function}' function.")
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or ""] if not node.level else ["relative import"]
+        elif isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "__import__":
+            modules = ["__import__"]
+        else:
+            continue
+        for module in modules:
+            if module.split(".")[0] in banned_imports or module in ("relative import", "__import__"):
+                raise CodeValidationError(f"The code uses {module}, which generated code may not import.")
+    return compile(tree, GENERATED_FILENAME, "exec")
+
+
+class CompiledCodeCache:
+    '''
+    Validated code objects and the functions they define, keyed on the source and function name
+    '''
+
+    def __init__(self, max_entries=256, banned_imports=BANNED_IMPORTS):
+        self.max_entries = max_entries
+        self.banned_imports = frozenset(banned_imports)
+        self._entries = OrderedDict()  # hash -> code object or CodeValidationError, most recently used last
+        self._functions = OrderedDict()  # hash -> function defined by running the code in this process
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "compiled": 0, "rejected": 0}
+
+    def _remember(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def compile(self, code, function):
+        '''
+        Returns (hash, code object) for normalized code, raising CodeValidationError for invalid code
+        '''
+        key = codeHash(code, function)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["rejected" if isinstance(entry, CodeValidationError) else "hits"] += 1
+        if entry is None:
+            try:
+                entry = compileCode(code, function, self.banned_imports)
+                outcome = "compiled"
+            except CodeValidationError as e:
+                entry = e
+                outcome = "rejected"
+            with self._lock:
+                self._remember(self._entries, key, entry)
+                self.stats[outcome] += 1
+        if isinstance(entry, CodeValidationError):
+            raise CodeValidationError(str(entry))
+        return key, entry
+
+    def function(self, code, function):
+        '''
+        The function code defines, running code in this process the first time it is seen
+        '''
+        key, code_object = self.compile(code, function)
+        with self._lock:
+            resolved = self._functions.get(key)
+        if resolved is None:
+            namespace = {}
+            exec(code_object, namespace)
+            resolved = namespace[function]
+            with self._lock:
+                self._remember(self._functions, key, resolved)
+        return resolved
+
+    def statsRow(self):
+        with self._lock:
+            return {"entries": len(self._entries), **self.stats}
+
+
+def writeFrame(df):
+    '''
+    Writes a DataFrame (or Series or scalar result) to an Arrow IPC file in shared memory and returns its path
+    '''
+    import pandas as pd
+
+    if isinstance(df, pd.Series):
+        df = df.to_frame()
+    elif not isinstance(df, pd.DataFrame):
+        df = pd.DataFrame({"result": [df]})
+    try:
+        table = pa.Table.from_pandas(df)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # Mixed-type object columns can't be expressed in Arrow, so send them as text
+        df = df.astype({column: str for column in df.select_dtypes(include=["object"]).columns})
+        table = pa.Table.from_pandas(df)
+
+    path = os.path.join(SHARED_DIR, f"sandbox-{uuid.uuid4().hex}.arrow")
+    with pa.OSFile(path, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+
+def readFrame(path, remove=True):
+    '''
+    Reads a DataFrame from an Arrow IPC file, removing the file afterwards when it was written by writeFrame
+    '''
+    try:
+        with pa.memory_map(path, "r") as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+    finally:
+        if remove:
+            os.remove(path)
+
+
+def _setCpuLimit(cpu_seconds):
+    if resource is None or not cpu_seconds:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = int(used + cpu_seconds) + 1
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _snowparkSession(sessions, connection_parameters):
+    key = tuple(sorted((k, v) for k, v in connection_parameters.items() if k != "private_key"))
+    if key not in sessions:
+        from snowflake.snowpark import Session
+
+        sessions[key] = Session.builder.configs(connection_parameters).create()
+    return sessions[key]
+
+
+def _resolveFunction(task, functions):
+    function = functions.get(task["code_hash"])
+    if function is None:
+        namespace = {}
+        exec(marshal.loads(task["code"]), namespace)
+        function = namespace.get(task["function"])
+        if not callable(function):
+            raise ValueError(f"The code did not define a '{task['function']}' function.")
+        functions[task["code_hash"]] = function
+        while len(functions) > WORKER_FUNCTION_CACHE_SIZE:
+            functions.popitem(last=False)
+    functions.move_to_end(task["code_hash"])
+    return function
+
+
+def _runTask(task, sessions, functions):
+    function = _resolveFunction(task, functions)
+
+    if task["kind"] == "analyze":
+        return writeFrame(function(readFrame(task["input"], remove=task["owns_input"])))
+    if task["kind"] == "charts":
+        fig1, fig2 = function(readFrame(task["input"], remove=task["owns_input"]))
+        return fig1.to_json(), fig2.to_json()
+    if task["kind"] == "snowpark":
+        session = _snowparkSession(sessions, task["snowflake"])
+        return writeFrame(function(session).to_pandas())
+    raise ValueError(f"Unknown task kind: {task['kind']}")
+
+
+def _describeError(error):
+    frames = [frame for frame in traceback.extract_tb(error.__traceback__) if frame.filename == GENERATED_FILENAME]
+    location = "".join(f"\n  line {frame.lineno}, in {frame.name}" for frame in frames)
+    return f"{type(error).__name__}: {error}{location}"
+
+
+def _workerMain(conn, address_space_bytes):
+    for module in WARM_IMPORTS:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+    if resource is not None and address_space_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (address_space_bytes, address_space_bytes))
+
+    sessions = {}  # Snowpark sessions live as long as the worker
+    functions = OrderedDict()  # Functions defined by code this worker has run, by code hash
+    conn.send(("ready", os.getpid()))
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        _setCpuLimit(task.get("cpu_seconds"))
+        try:
+            conn.send(("ok", _runTask(task, sessions, functions)))
+        except MemoryError:
+            conn.send(("error", "MemoryError: the generated code ran out of memory"))
+        except BaseException as e:
+            conn.send(("error", _describeError(e)))
+
+
+def _residentBytes(pid):
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class _Worker:
+    def __init__(self, context, address_space_bytes):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_workerMain, args=(child_conn, address_space_bytes), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def waitUntilReady(self, timeout):
+        if not self.conn.poll(timeout):
+            raise SandboxError("Sandbox worker did not start in time")
+        self.conn.recv()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class SandboxPool:
+    '''
+    Fixed-size pool of pre-warmed worker processes, each running one task at a time
+    '''
+
+    def __init__(self, size, wall_seconds, cpu_seconds, max_rss_bytes, address_space_bytes=None,
+                 checkout_timeout=120, startup_timeout=120, code_cache=None):
+        self.size = size
+        self.code_cache = code_cache or CompiledCodeCache()
+        self.wall_seconds = wall_seconds
+        self.cpu_seconds = cpu_seconds
+        self.max_rss_bytes = max_rss_bytes
+        self.address_space_bytes = address_space_bytes
+        self.checkout_timeout = checkout_timeout
+        self.startup_timeout = startup_timeout
+        self._context = multiprocessing.get_context("spawn")
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self.stats = {"runs": 0, "failures": 0, "timeouts": 0, "memory_kills": 0, "recycled": 0,
+                      "total_seconds": 0.0}
+        for _ in range(size):
+            self._spawnInBackground()
+
+    def _spawn(self):
+        worker = _Worker(self._context, self.address_space_bytes)
+        try:
+            worker.waitUntilReady(self.startup_timeout)
+        except Exception as e:
+            print(f"Sandbox worker failed to start: {e}")
+            worker.kill()
+            time.sleep(1)
+            self._spawnInBackground()
+            return
+        self._idle.put(worker)
+
+    def _spawnInBackground(self):
+        threading.Thread(target=self._spawn, daemon=True).start()
+
+    def _recycle(self, worker):
+        worker.kill()
+        with self._lock:
+            self.stats["recycled"] += 1
+        self._spawnInBackground()
+
+    def _record(self, key, seconds=None):
+        with self._lock:
+            self.stats[key] += 1
+            if seconds is not None:
+                self.stats["total_seconds"] += seconds
+
+    def _wait(self, worker, wall_seconds):
+        deadline = time.monotonic() + wall_seconds
+        while not worker.conn.poll(0.05):
+            if not worker.process.is_alive():
+                self._raiseWorkerDied(worker)
+            if time.monotonic() > deadline:
+                self._record("timeouts")
+                raise SandboxTimeout(f"The generated code did not finish within {wall_seconds}s")
+            if self.max_rss_bytes and _residentBytes(worker.process.pid) > self.max_rss_bytes:
+                self._record("memory_kills")
+                raise SandboxMemoryError(
+                    f"The generated code used more than {self.max_rss_bytes // 1_000_000} MB of memory")
+        try:
+            return worker.conn.recv()
+        except EOFError:
+            self._raiseWorkerDied(worker)
+
+    def _raiseWorkerDied(self, worker):
+        worker.process.join(timeout=5)
+        if resource is not None and worker.process.exitcode == -signal.SIGXCPU:
+            # RLIMIT_CPU ends the worker with SIGXCPU
+            self._record("timeouts")
+            raise SandboxTimeout(f"The generated code was stopped after using {self.cpu_seconds}s of CPU time")
+        raise SandboxError(f"The sandbox worker died (exit code {worker.process.exitcode})")
+
+    def run(self, kind, code, function, df=None, snowflake=None, wall_seconds=None, df_path=None):
+        '''
+        Runs the function code defines on df ("analyze", "charts") or on a Snowpark session ("snowpark") in a worker.
+        df_path is an Arrow file that already holds df, which the worker then reads in place.
+        '''
+        code_hash, code_object = self.code_cache.compile(normalizeCode(code), function)
+        try:
+            worker = self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise SandboxError(f"No sandbox worker became free within {self.checkout_timeout}s")
+
+        start = time.perf_counter()
+        task = {"kind": kind, "code": marshal.dumps(code_object), "code_hash": code_hash, "function": function,
+                "input": None, "owns_input": True, "snowflake": snowflake, "cpu_seconds": self.cpu_seconds}
+        try:
+            if df_path is not None and os.path.exists(df_path):
+                task["input"], task["owns_input"] = df_path, False
+            elif df is not None:
+                task["input"] = writeFrame(df)
+            worker.conn.send(task)
+            status, payload = self._wait(worker, wall_seconds or self.wall_seconds)
+        except BaseException:
+            self._record("failures", time.perf_counter() - start)
+            self._recycle(worker)
+            raise
+        finally:
+            if task["owns_input"] and task["input"] is not None and os.path.exists(task["input"]):
+                os.remove(task["input"])
+
+        if status != "ok":
+            self._record("failures", time.perf_counter() - start)
+            self._recycle(worker)
+            raise SandboxError(payload)
+
+        self._record("runs", time.perf_counter() - start)
+        self._idle.put(worker)
+        if kind in ("analyze", "snowpark"):
+            return readFrame(payload)
+        return payload
+
+    def statsRow(self):
+        with self._lock:
+            return {"workers": self.size, "idle": self._idle.qsize(), **self.stats}
@@ -1,20 +1,48 @@
 import re
+import asyncio
 import concurrent.futures
+from contextlib import contextmanager
 import os
 import requests
 import ast
+import hashlib
+import importlib.util
+import io
+import itertools
 import json
-
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import urllib.parse
+import weakref
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import markdown
+from requests.adapters import HTTPAdapter
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 import plotly.io as pio
-import base64
 import snowflake.connector
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import OptimizeError, SqlglotError
+from sqlglot.optimizer.normalize_identifiers import normalize_identifiers
+from sqlglot.optimizer.qualify import qualify
 from openai import OpenAI
 
+import chartRules
+import codeSandbox
+import promptBuilder
+import sqlTables
+
 client = OpenAI(api_key=st.secrets.openai_credentials.key)
 st.set_page_config(page_title="AI Data Analyst", page_icon=":sparkles:", layout="wide")
 
@@ -25,6 +53,133 @@ pd.set_option('display.width', 1000)
 # Set to True to use a single OpenAI deployment for all request. False to separate requests to different deployments.
 openAImode = True
 
+# Performance tuning. Any of these can be overridden from an optional [performance] section in secrets.toml.
+performance_settings = {
+    # DataRobot prediction client
+    "prediction_connect_timeout": 5,
+    "prediction_read_timeout": 120,
+    "prediction_max_retries": 4,
+    "prediction_backoff_base": 0.5,
+    "prediction_backoff_max": 8,
+    "prediction_pool_size": 16,
+    # With openAImode on, the business analysis is streamed from this OpenAI model; None sends it to the DataRobot
+    # business_analysis deployment instead, which returns it in one piece
+    "business_analysis_openai_model": "gpt-4o",
+    # Persistent caches shared by every process on the host
+    "cache_db_path": os.path.join(tempfile.gettempdir(), "ai-data-analyst", "cache.sqlite"),
+    # LLM response cache
+    "llm_cache_ttl": 7 * 24 * 60 * 60,
+    "llm_cache_max_entries": 20000,
+    "llm_cache_pending_entries": 1000,
+    "llm_cache_semantic": False,
+    "llm_cache_similarity_threshold": 0.95,
+    "llm_cache_embedding_model": "text-embedding-3-small",
+    # Generated SQL result cache
+    "query_cache_enabled": True,
+    "query_cache_ttl": 24 * 60 * 60,
+    "query_cache_result_scan_min_seconds": 5,
+    # Generated SQL results are fetched in Arrow batches up to these budgets, then truncated
+    "query_max_rows": 100000,
+    "query_max_mb": 256,
+    # Result tables with more rows than this are shown in a scrolling grid instead of a static table
+    "results_static_table_rows": 100,
+    # Generated SQL is parsed, checked against the table schemas and EXPLAINed before it runs. Queries that would
+    # scan more than sql_limit_scan_gb get a LIMIT when they have none; over sql_reject_scan_gb they are rejected.
+    "sql_validation_enabled": True,
+    "sql_limit_scan_gb": 50,
+    "sql_reject_scan_gb": 1000,
+    "sql_auto_limit_rows": 10000,
+    # Queries are classed from their EXPLAIN estimate (metadata: no partitions, sample: up to
+    # query_class_sample_max_gb scanned, analytical: more) and run on snowflake_credentials.warehouses[class],
+    # falling back to the configured warehouse, with a statement timeout per class
+    "query_router_enabled": True,
+    "query_class_sample_max_gb": 1,
+    "query_class_timeouts": {"metadata": 60, "sample": 120, "analytical": 900},
+    # Speculative SQL: generate this many candidates at once, validate them and run the most promising
+    # sql_speculative_run of them concurrently; the first non-empty result wins. Off (1) by default, as every raced
+    # query is billed; when most candidates agree on the same SQL only that one runs.
+    "sql_speculative_candidates": 1,
+    "sql_speculative_run": 2,
+    "sql_speculative_poll_seconds": 0.2,
+    # Snowflake connection pool
+    "snowflake_pool_max_size": 8,
+    "snowflake_pool_idle_timeout": 600,
+    "snowflake_pool_health_check_interval": 60,
+    "snowflake_pool_checkout_timeout": 60,
+    "snowflake_session_parameters": {"QUERY_TAG": "ai-data-analyst"},
+    # Table profiling
+    "table_profiler_workers": 8,
+    "profile_cache_entries": 32,
+    # CSV ingestion
+    "csv_use_pyarrow": True,
+    "csv_dtype_sample_rows": 10000,
+    "csv_chunk_rows": 250000,
+    "csv_category_max_unique": 1000,
+    "csv_category_max_ratio": 0.5,
+    "csv_downcast_floats": True,
+    # Local Arrow dataset store for uploads and table samples
+    "dataset_store_dir": os.path.join(tempfile.gettempdir(), "ai-data-analyst", "datasets"),
+    "dataset_store_disk_budget_mb": 5000,
+    "dataset_store_memory_budget_mb": 2000,
+    "dataset_sample_ttl": 24 * 60 * 60,
+    # Worker processes that run generated code
+    "sandbox_enabled": True,
+    "sandbox_workers": 2,
+    "sandbox_wall_seconds": 60,
+    "sandbox_chart_wall_seconds": 30,
+    "sandbox_cpu_seconds": 60,
+    "sandbox_max_rss_mb": 2048,
+    "sandbox_address_space_mb": None,
+    # Chart and analysis stages: each has its own deadline; chart retries send only the latest errors, in brief
+    "chart_deadline_seconds": 120,
+    "chart_max_attempts": 6,
+    "chart_feedback_attempts": 2,
+    "analysis_deadline_seconds": 150,
+    "stage_workers": 16,
+    # Rule-based charts are drawn as soon as results arrive and kept when the LLM charts fail; results with at most
+    # this many columns keep them and skip the LLM altogether
+    "chart_rules_enabled": True,
+    "chart_rules_final_max_columns": 2,
+    # HTML report: built when downloaded, with plotly.js from the CDN ("cdn") or inlined once (True)
+    "report_plotlyjs": "cdn",
+    "report_max_rows": 1000,
+    "report_dir": os.path.join(tempfile.gettempdir(), "ai-data-analyst", "reports"),
+    "report_ttl": 60 * 60,
+    # Validated, compiled generated code kept per process; imports generated code is refused
+    "code_cache_entries": 256,
+    "code_banned_imports": sorted(codeSandbox.BANNED_IMPORTS),
+    # Prompt size limits, in tokens of the user prompt sent to each deployment
+    "prompt_token_budgets": {
+        "sql_code_generator": 24000,
+        "python_code_generator": 24000,
+        "plotly_code_generator": 8000,
+        "business_analysis": 16000,
+        "data_dictionary_maker": 6000,
+    },
+    "prompt_tokenizer_encoding": "o200k_base",
+    "prompt_frame_max_rows": 50,
+    "prompt_frame_max_columns": 40,
+    # CSV data dictionary: columns per chunk on average, the most tokens a chunk may use and parallel requests
+    "dictionary_chunk_columns": 10,
+    "dictionary_chunk_tokens": 3000,
+    "dictionary_workers": 4,
+    # How long table schemas (and so the dictionary diff) are reused before Snowflake is asked again
+    "table_schema_ttl": 10 * 60,
+    # Secoda catalog client
+    "secoda_cache_ttl": 60 * 60,
+    "secoda_timeout": 30,
+    "secoda_page_workers": 4,
+    "secoda_prefetch": True,
+    # Rows sampled from each selected table
+    "table_sample_size": 1000,
+    # Background warm-up of every configured table and every combination of up to warmup_max_tables of them
+    "warmup_enabled": True,
+    "warmup_max_tables": 2,
+    "warmup_workers": 2,
+    "warmup_interval": 6 * 60 * 60,
+}
+performance_settings.update(st.secrets.get("performance", {}))
+
 # Snowflake connection details
 user = st.secrets.snowflake_credentials.user
 password = st.secrets.snowflake_credentials.password
@@ -77,8 +232,6 @@ def initialize_session_state():
         'frequentValues': pd.DataFrame(),
         'datarobot_logo_svg': '',
         'customer_logo_svg': '',
-        'html_content': '',
-        'download_link': '',
         'csvUploadButton': None,
     }
     for key, value in default_values.items():
@@ -86,548 +239,2134 @@ def initialize_session_state():
 
 initialize_session_state()
 
+# Status codes from the prediction server that are worth retrying
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
-@st.cache_data(show_spinner=False)
-def getSnowflakeTableDescriptions(tables, user, _private_key, account, warehouse, database, schema):
-    # Establish a connection to Snowflake
+
+@st.cache_resource(show_spinner=False)
+def getPredictionSession(prediction_server):
+    '''
+    Returns a keep-alive HTTP session for a prediction server, shared by every user of this process
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=performance_settings["prediction_pool_size"])
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        'Content-Type': 'application/json; charset=UTF-8',
+        'Authorization': 'Bearer {}'.format(st.secrets.datarobot_credentials.API_KEY),
+        'DataRobot-Key': st.secrets.datarobot_credentials.DATAROBOT_KEY,
+    })
+    return session
+
+
+@st.cache_resource(show_spinner=False)
+def getDeploymentStats():
+    '''
+    Process-wide call statistics per deployment: calls, retries, errors, latency and bytes sent/received
+    '''
+    return {"lock": threading.Lock(), "deployments": {}}
+
+
+def deploymentStatsEntry(stats, deployment):
+    return stats["deployments"].setdefault(deployment, {
+        "calls": 0, "retries": 0, "errors": 0, "total_latency": 0.0, "max_latency": 0.0,
+        "bytes_sent": 0, "bytes_received": 0, "cache_hit": 0, "cache_semantic_hit": 0, "cache_miss": 0,
+        "cache_bypass": 0, "cache_error": 0,
+    })
+
+
+def recordDeploymentCall(deployment, latency, bytes_sent, bytes_received, retries, failed):
+    stats = getDeploymentStats()
+    with stats["lock"]:
+        entry = deploymentStatsEntry(stats, deployment)
+        entry["calls"] += 1
+        entry["retries"] += retries
+        entry["errors"] += int(failed)
+        entry["total_latency"] += latency
+        entry["max_latency"] = max(entry["max_latency"], latency)
+        entry["bytes_sent"] += bytes_sent
+        entry["bytes_received"] += bytes_received
+
+
+def getDeploymentStatsFrame():
+    stats = getDeploymentStats()
+    with stats["lock"]:
+        rows = [{"deployment": name, **entry} for name, entry in stats["deployments"].items()]
+    frame = pd.DataFrame(rows)
+    if not frame.empty:
+        frame["mean_latency"] = frame["total_latency"] / frame["calls"]
+    return frame
+
+
+def postToDeployment(deployment, systemPrompt, promptText):
+    '''
+    Sends one prompt to a DataRobot LLM deployment and returns the prediction text.
+    deployment is the key of the deployment in st.secrets.datarobot_deployment_id.
+    Retries connection errors, timeouts, 429 and 5xx responses with jittered exponential backoff.
+    '''
+    deployment_id = st.secrets.datarobot_deployment_id[deployment]
+    prediction_server = st.secrets.datarobot_credentials.PREDICTION_SERVER
+    url = f'{prediction_server}/predApi/v1.0/deployments/{deployment_id}/predictions'
+    session = getPredictionSession(prediction_server)
+    payload = json.dumps([{"systemPrompt": systemPrompt, "promptText": promptText}]).encode("utf-8")
+    timeout = (performance_settings["prediction_connect_timeout"], performance_settings["prediction_read_timeout"])
+    max_retries = performance_settings["prediction_max_retries"]
+
+    start = time.perf_counter()
+    bytes_received = 0
+    attempt = 0
     try:
-        conn = snowflake.connector.connect(
-            user=user,
-            private_key=_private_key,
-            account=account,
-            warehouse=warehouse,
-            database=database,
-            schema=schema,
-            role=role,
-            # Enable case sensitivity for identifiers
-            case_sensitive_identifier_quoting=True
-        )
-        cursor = conn.cursor()
-    except Exception as e:
-        print(f"Error connecting to Snowflake: {e}")
-        return None
+        while True:
+            retry_after = None
+            try:
+                response = session.post(url, data=payload, timeout=timeout)
+                bytes_received += len(response.content)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= max_retries:
+                    response.raise_for_status()
+                    prediction = response.json()["data"][0]["prediction"]
+                    break
+                retry_after = response.headers.get("Retry-After")
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= max_retries:
+                    raise
+            attempt += 1
+            backoff = min(performance_settings["prediction_backoff_max"],
+                          performance_settings["prediction_backoff_base"] * 2 ** attempt)
+            delay = random.uniform(0, backoff)
+            if retry_after is not None and retry_after.isdigit():
+                delay = max(delay, float(retry_after))
+            time.sleep(delay)
+    except Exception:
+        recordDeploymentCall(deployment, time.perf_counter() - start, len(payload) * (attempt + 1), bytes_received,
+                             attempt, failed=True)
+        raise
+
+    # Latency, bytes and retries are shown in the sidebar Performance panel
+    recordDeploymentCall(deployment, time.perf_counter() - start, len(payload) * (attempt + 1), bytes_received,
+                         attempt, failed=False)
+    return prediction
+
+
+class CacheDatabase:
+    '''
+    SQLite database behind the persistent caches. WAL mode lets every process on the host share it.
+    '''
 
-    # Function to get primary keys of a table
-    def get_primary_keys(table_name):
-        try:
-            cursor.execute(f"""
-                SELECT COLUMN_NAME
-                FROM {database}.INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc
-                JOIN {database}.INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu
-                ON tc.CONSTRAINT_NAME = kcu.CONSTRAINT_NAME
-                WHERE tc.CONSTRAINT_TYPE = 'PRIMARY KEY'
-                AND tc.TABLE_SCHEMA = '{schema}'
-                AND tc.TABLE_NAME = '{table_name}'
-                """)
-            return [row[0] for row in cursor.fetchall()]
-        except Exception as e:
-            print(f"Error fetching primary keys for table {table_name}: {e}")
-            return []
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._lock = threading.Lock()
 
-    # Function to get columns and data types along with additional metadata
-    def get_columns_and_types(table_name):
-        try:
-            cursor.execute(f"""
-                SELECT COLUMN_NAME, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT, COMMENT
-                FROM {database}.INFORMATION_SCHEMA.COLUMNS
-                WHERE TABLE_SCHEMA = '{schema}'
-                AND TABLE_NAME = '{table_name}'
-                """)
-            columns = cursor.fetchall()
-            primary_keys = get_primary_keys(table_name)
-            return [(col[0], col[1], col[2] == 'YES', col[3], col[0] in primary_keys, col[4]) for col in columns]
-        except Exception as e:
-            print(f"Error fetching columns and types for table {table_name}: {e}")
-            return []
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def executescript(self, script):
+        with self._lock:
+            self._conn.executescript(script)
+
+
+@st.cache_resource(show_spinner=False)
+def getCacheDatabase():
+    return CacheDatabase(performance_settings["cache_db_path"])
+
+
+# Error feedback that execute_query_with_retries and the chart retries append to a prompt
+RETRY_FEEDBACK_PATTERNS = [
+    re.compile(r'\nQUERY FAILED! Attempt \d+ failed with error: .*?(?=\nQUERY FAILED! Attempt |\nSNOWFLAKE ENVIRONMENT:|\Z)',
+               re.DOTALL),
+    re.compile(r'\nCHART CODE FAILED! Attempt \d+: [^\n]*'),
+]
 
-    # Function to get table comment
-    def get_table_comment(table_name):
+def normalizePrompt(text):
+    if not isinstance(text, str):
+        text = json.dumps(text, sort_keys=True, default=str)
+    text = unicodedata.normalize("NFKC", text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    text = re.sub(r' ?\n ?', '\n', text)
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    return text.strip()
+
+def stripRetryFeedback(text):
+    for pattern in RETRY_FEEDBACK_PATTERNS:
+        text = pattern.sub('', text)
+    return text
+
+
+class ResponseCache:
+    '''
+    Persistent cache of LLM responses, shared by every session and process and kept across restarts.
+    Prompts are normalized before keying. A prompt that carries retry feedback never reads from the cache, but its
+    response is written under the prompt without the feedback. Generated code is only written once it has run
+    (see deferCachedResponse), so the answer that finally worked is the one the next identical question gets.
+    Entries expire after ttl seconds and the least recently used are removed past
+    max_entries. With semantic matching on, a prompt whose business question is close enough (by embedding
+    cosine similarity) to a cached one with exactly the same remaining context reuses that answer.
+    '''
+
+    def __init__(self, database, ttl, max_entries, similarity_threshold=None, embed=None):
+        self.database = database
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.embed = embed
+        database.executescript("""
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                key TEXT PRIMARY KEY,
+                deployment TEXT NOT NULL,
+                context_key TEXT,
+                embedding BLOB,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS llm_responses_context ON llm_responses (deployment, context_key);
+            CREATE INDEX IF NOT EXISTS llm_responses_last_used ON llm_responses (last_used);
+            """)
+
+    @staticmethod
+    def _hash(*parts):
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def _keys(self, deployment, systemPrompt, promptText):
+        system = normalizePrompt(systemPrompt)
+        prompt = normalizePrompt(promptText)
+        base_prompt = stripRetryFeedback(prompt)
+        key = self._hash(deployment, system, base_prompt)
+        # The semantic context is everything except the business question
+        question = re.search(r'^Business Question: ?(.*)$', base_prompt, re.MULTILINE)
+        if question is None or not question.group(1).strip():
+            return key, base_prompt != prompt, None, None
+        context = base_prompt[:question.start(1)] + base_prompt[question.end(1):]
+        return key, base_prompt != prompt, self._hash(deployment, system, context), question.group(1).strip()
+
+    def lookup(self, deployment, systemPrompt, promptText):
+        '''
+        Returns (response, outcome) where outcome is "hit", "semantic_hit", "miss" or "bypass"
+        '''
+        key, has_feedback, context_key, question = self._keys(deployment, systemPrompt, promptText)
+        if has_feedback:
+            return None, "bypass"
+        now = time.time()
+        rows = self.database.execute("SELECT response FROM llm_responses WHERE key = ? AND created_at > ?",
+                                     (key, now - self.ttl))
+        if rows:
+            self.database.execute("UPDATE llm_responses SET last_used = ? WHERE key = ?", (now, key))
+            return rows[0][0], "hit"
+
+        if self.similarity_threshold and self.embed and context_key is not None:
+            candidates = self.database.execute(
+                "SELECT key, embedding, response FROM llm_responses "
+                "WHERE deployment = ? AND context_key = ? AND embedding IS NOT NULL AND created_at > ?",
+                (deployment, context_key, now - self.ttl))
+            if candidates:
+                vector = self._embed(question)
+                if vector is not None:
+                    matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in candidates])
+                    similarities = matrix @ vector
+                    best = int(np.argmax(similarities))
+                    if similarities[best] >= self.similarity_threshold:
+                        self.database.execute("UPDATE llm_responses SET last_used = ? WHERE key = ?",
+                                              (now, candidates[best][0]))
+                        return candidates[best][2], "semantic_hit"
+        return None, "miss"
+
+    def _embed(self, question):
         try:
-            cursor.execute(f"""
-                SELECT COMMENT
-                FROM {database}.INFORMATION_SCHEMA.TABLES
-                WHERE TABLE_SCHEMA = '{schema}'
-                AND TABLE_NAME = '{table_name}'
-                """)
-            result = cursor.fetchone()
-            return result[0] if result else None
+            vector = np.asarray(self.embed(question), dtype=np.float32)
         except Exception as e:
-            print(f"Error fetching table comment for {table_name}: {e}")
+            print(f"Response cache: could not embed the question: {e}")
             return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def store(self, deployment, systemPrompt, promptText, response):
+        key, _, context_key, question = self._keys(deployment, systemPrompt, promptText)
+        embedding = None
+        if self.similarity_threshold and self.embed and question is not None:
+            vector = self._embed(question)
+            embedding = vector.tobytes() if vector is not None else None
+        now = time.time()
+        self.database.execute(
+            "INSERT OR REPLACE INTO llm_responses (key, deployment, context_key, embedding, response, created_at, "
+            "last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, deployment, context_key, embedding, response, now, now))
+        self.database.execute("DELETE FROM llm_responses WHERE created_at <= ?", (now - self.ttl,))
+        self.database.execute(
+            "DELETE FROM llm_responses WHERE key IN (SELECT key FROM llm_responses ORDER BY last_used DESC "
+            "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+
+def embedQuestion(question):
+    response = client.embeddings.create(model=performance_settings["llm_cache_embedding_model"], input=question)
+    return response.data[0].embedding
+
+
+@st.cache_resource(show_spinner=False)
+def getResponseCache():
+    semantic = performance_settings["llm_cache_semantic"]
+    return ResponseCache(
+        getCacheDatabase(),
+        ttl=performance_settings["llm_cache_ttl"],
+        max_entries=performance_settings["llm_cache_max_entries"],
+        similarity_threshold=performance_settings["llm_cache_similarity_threshold"] if semantic else None,
+        embed=embedQuestion if semantic else None,
+    )
+
+
+def recordCacheLookup(deployment, outcome):
+    stats = getDeploymentStats()
+    with stats["lock"]:
+        deploymentStatsEntry(stats, deployment)[f"cache_{outcome}"] += 1
+
+
+def lookupCachedResponse(deployment, systemPrompt, promptText):
+    try:
+        response, outcome = getResponseCache().lookup(deployment, systemPrompt, promptText)
+    except sqlite3.Error as e:
+        print(f"Response cache lookup failed: {e}")
+        response, outcome = None, "error"
+    recordCacheLookup(deployment, outcome)
+    return response
 
-    # Function to get table row count
-    def get_table_row_count(table_name):
+
+def storeCachedResponse(deployment, systemPrompt, promptText, response):
+    try:
+        getResponseCache().store(deployment, systemPrompt, promptText, response)
+    except sqlite3.Error as e:
+        print(f"Response cache store failed: {e}")
+
+
+def callDeployment(deployment, systemPrompt, promptText, store=True, refresh=False):
+    '''
+    Returns the response of a DataRobot LLM deployment to a prompt, from the response cache when possible.
+    With store=False a new response is not cached; code generators defer that until the code has run.
+    With refresh=True the deployment is always called and its response replaces the cached one.
+    '''
+    response = None if refresh else lookupCachedResponse(deployment, systemPrompt, promptText)
+    if response is None:
+        response = postToDeployment(deployment, systemPrompt, promptText)
+        if store:
+            storeCachedResponse(deployment, systemPrompt, promptText, response)
+    return response
+
+
+@st.cache_resource(show_spinner=False)
+def getPendingResponses():
+    '''
+    Generated code that has not run yet, keyed by the code: the deployment call that produced it
+    '''
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+
+def deferCachedResponse(code, deployment, systemPrompt, promptText, response):
+    '''
+    Holds the response that produced code until confirmCachedResponse(code) says the code ran
+    '''
+    pending = getPendingResponses()
+    with pending["lock"]:
+        pending["entries"][code] = (deployment, systemPrompt, promptText, response)
+        pending["entries"].move_to_end(code)
+        while len(pending["entries"]) > performance_settings["llm_cache_pending_entries"]:
+            pending["entries"].popitem(last=False)
+
+
+def confirmCachedResponse(code):
+    '''
+    Caches the response that produced code, now that the code has run and returned a result
+    '''
+    pending = getPendingResponses()
+    with pending["lock"]:
+        entry = pending["entries"].pop(code, None)
+    if entry is not None:
+        storeCachedResponse(*entry)
+
+
+class SnowflakePool:
+    '''
+    Thread-safe pool of open Snowflake connections or Snowpark sessions, shared by every user of this process.
+    Idle resources are closed after idle_timeout seconds and health-checked before reuse when they have been
+    idle for more than health_check_interval seconds. At most max_size resources are open at once.
+    '''
+
+    def __init__(self, name, create, is_healthy, close, max_size, idle_timeout, health_check_interval,
+                 checkout_timeout):
+        self.name = name
+        self._create = create
+        self._is_healthy = is_healthy
+        self._close = close
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self._idle = []  # (resource, last_used) pairs, most recently used last
+        self._checked_out = {}  # id(resource) -> checkout time
+        self._size = 0
+        self._condition = threading.Condition()
+        self.stats = {"checkouts": 0, "created": 0, "closed": 0, "total_wait": 0.0, "max_wait": 0.0,
+                      "total_held": 0.0}
+
+    def _discard(self, resource):
         try:
-            cursor.execute(f"SELECT COUNT(*) FROM {schema}.{table_name}")
-            result = cursor.fetchone()
-            return result[0] if result else None
+            self._close(resource)
         except Exception as e:
-            print(f"Error fetching row count for table {table_name}: {e}")
-            return None
+            print(f"{self.name}: error closing pooled resource: {e}")
+        with self._condition:
+            self._size -= 1
+            self.stats["closed"] += 1
+            self._condition.notify()
+
+    def _evictIdle(self):
+        now = time.monotonic()
+        with self._condition:
+            expired = [item for item in self._idle if now - item[1] > self.idle_timeout]
+            self._idle = [item for item in self._idle if now - item[1] <= self.idle_timeout]
+        for resource, _ in expired:
+            self._discard(resource)
+
+    def acquire(self):
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.checkout_timeout
+        self._evictIdle()
+        while True:
+            resource = None
+            create = False
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"{self.name}: no connection available after {self.checkout_timeout}s")
+                    self._condition.wait(remaining)
+                if self._idle:
+                    resource, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+
+            if create:
+                try:
+                    resource = self._create()
+                except Exception:
+                    with self._condition:
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self.stats["created"] += 1
+            elif time.monotonic() - last_used > self.health_check_interval and not self._checkHealth(resource):
+                self._discard(resource)
+                continue
+
+            wait = time.perf_counter() - start
+            with self._condition:
+                self._checked_out[id(resource)] = time.perf_counter()
+                self.stats["checkouts"] += 1
+                self.stats["total_wait"] += wait
+                self.stats["max_wait"] = max(self.stats["max_wait"], wait)
+            return resource
+
+    def _checkHealth(self, resource):
+        try:
+            return self._is_healthy(resource)
+        except Exception as e:
+            print(f"{self.name}: pooled resource failed its health check: {e}")
+            return False
+
+    def release(self, resource):
+        with self._condition:
+            checked_out_at = self._checked_out.pop(id(resource), None)
+            if checked_out_at is not None:
+                self.stats["total_held"] += time.perf_counter() - checked_out_at
+            self._idle.append((resource, time.monotonic()))
+            self._condition.notify()
+
+    @contextmanager
+    def checkout(self):
+        resource = self.acquire()
+        try:
+            yield resource
+        finally:
+            self.release(resource)
 
-    # Prepare the descriptions string
-    descriptions = ""
+    def statsRow(self):
+        with self._condition:
+            row = {"pool": self.name, "open": self._size, "idle": len(self._idle), **self.stats}
+        row["mean_wait"] = row["total_wait"] / row["checkouts"] if row["checkouts"] else 0.0
+        return row
 
-    for table in tables:
-        descriptions += f"Table: {table}\n"
-        table_comment = get_table_comment(table)
-        if table_comment:
-            descriptions += f" Comment: {table_comment}\n"
-        row_count = get_table_row_count(table)
-        descriptions += f" Row Count: {row_count}\n"
-        for col_name, col_type, nullable, default, is_primary, col_comment in get_columns_and_types(table):
-            descriptions += f' Column: "{col_name}", Type: {col_type}, Nullable: {nullable}, Default: {default}, Primary Key: {is_primary}, Comment: {col_comment}\n'
-        descriptions += "---------------------------------------------------------------\n"
-
-    # Close the connection
-    cursor.close()
-    conn.close()
-
-    return descriptions
 
-@st.cache_data(show_spinner=False)
-def suggestQuestion(description):
-    # description = "this is a test."
-    systemPrompt = st.secrets.prompts.suggest_a_question
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [description]})
-    deployment_id = st.secrets.datarobot_deployment_id.summarize_table
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
+def connectToSnowflake(user, private_key, account, warehouse, database, schema, role):
+    return snowflake.connector.connect(
+        user=user,
+        private_key=private_key,
+        account=account,
+        warehouse=warehouse,
+        database=database,
+        schema=schema,
+        role=role,
+        # Enable case sensitivity for identifiers
+        case_sensitive_identifier_quoting=True,
+        # Keep pooled sessions (and their session parameters) alive between questions
+        client_session_keep_alive=True,
+        session_parameters=dict(performance_settings["snowflake_session_parameters"]),
+    )
 
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
+
+def isSnowflakeConnectionHealthy(conn):
+    if conn.is_closed():
+        return False
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1")
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def getSnowflakePool(user, _private_key, account, warehouse, database, schema, role):
+    return SnowflakePool(
+        name="snowflake connections",
+        create=lambda: connectToSnowflake(user, _private_key, account, warehouse, database, schema, role),
+        is_healthy=isSnowflakeConnectionHealthy,
+        close=lambda conn: conn.close(),
+        max_size=performance_settings["snowflake_pool_max_size"],
+        idle_timeout=performance_settings["snowflake_pool_idle_timeout"],
+        health_check_interval=performance_settings["snowflake_pool_health_check_interval"],
+        checkout_timeout=performance_settings["snowflake_pool_checkout_timeout"],
     )
-    print(data.to_json(orient='records'))
-    print(predictions_response.json())
-    suggestion = predictions_response.json()["data"][0]["prediction"]
+
+
+@st.cache_resource(show_spinner=False)
+def getSnowparkPool(user, _private_key, account, warehouse, database, schema, role):
+    from snowflake.snowpark import Session
+
+    def create():
+        conn = connectToSnowflake(user, _private_key, account, warehouse, database, schema, role)
+        return Session.builder.configs({"connection": conn}).create()
+
+    def is_healthy(session):
+        session.sql("SELECT 1").collect()
+        return True
+
+    return SnowflakePool(
+        name="snowpark sessions",
+        create=create,
+        is_healthy=is_healthy,
+        close=lambda session: session.close(),
+        max_size=performance_settings["snowflake_pool_max_size"],
+        idle_timeout=performance_settings["snowflake_pool_idle_timeout"],
+        health_check_interval=performance_settings["snowflake_pool_health_check_interval"],
+        checkout_timeout=performance_settings["snowflake_pool_checkout_timeout"],
+    )
+
+
+@st.cache_data(show_spinner=False, ttl=performance_settings["table_schema_ttl"])
+def loadSnowflakeTableSchemas(tables, user, _private_key, account, warehouse, database, schema):
+    '''
+    Loads comments, row counts, columns and primary keys for all the given tables in two set-based queries.
+    Returns {table: {"name", "comment", "row_count", "columns": [{"name", "data_type", "nullable", "default",
+    "primary_key", "comment"}]}} in the order the tables were given. Raises when the metadata can't be read, so
+    that a failure is never cached.
+    '''
+    tables = list(tables)
+    schemas = {table: {"name": table, "comment": None, "row_count": None, "columns": []} for table in tables}
+    if not tables:
+        return schemas
+
+    pool = getSnowflakePool(user, _private_key, account, warehouse, database, schema, role)
+    conn = pool.acquire()
+    try:
+        routeQuery(conn, "metadata")
+        with conn.cursor() as cursor:
+            # Columns joined to their table. ROW_COUNT comes from the metadata, so no table is scanned.
+            placeholders = ", ".join(["%s"] * len(tables))
+            cursor.execute(f"""
+                SELECT c.TABLE_NAME, t.COMMENT, t.ROW_COUNT,
+                       c.COLUMN_NAME, c.DATA_TYPE, c.IS_NULLABLE, c.COLUMN_DEFAULT, c.COMMENT
+                FROM {database}.INFORMATION_SCHEMA.COLUMNS c
+                JOIN {database}.INFORMATION_SCHEMA.TABLES t
+                ON t.TABLE_SCHEMA = c.TABLE_SCHEMA AND t.TABLE_NAME = c.TABLE_NAME
+                WHERE c.TABLE_SCHEMA = %s
+                AND c.TABLE_NAME IN ({placeholders})
+                ORDER BY c.TABLE_NAME, c.ORDINAL_POSITION
+                """, [schema, *tables])
+            for table_name, table_comment, row_count, col_name, col_type, nullable, default, col_comment in cursor:
+                table_schema = schemas.get(table_name)
+                if table_schema is None:
+                    continue
+                table_schema["comment"] = table_comment
+                table_schema["row_count"] = row_count
+                table_schema["columns"].append({
+                    "name": col_name,
+                    "data_type": col_type,
+                    "nullable": nullable == 'YES',
+                    "default": default,
+                    "primary_key": False,
+                    "comment": col_comment,
+                })
+
+            # Primary keys for the whole schema in one call
+            try:
+                cursor.execute(f"SHOW PRIMARY KEYS IN SCHEMA {database}.{schema}")
+                fields = [column[0].lower() for column in cursor.description]
+                table_index, column_index = fields.index("table_name"), fields.index("column_name")
+                primary_keys = {(row[table_index], row[column_index]) for row in cursor}
+                for table_schema in schemas.values():
+                    for column in table_schema["columns"]:
+                        column["primary_key"] = (table_schema["name"], column["name"]) in primary_keys
+            except Exception as e:
+                print(f"Error fetching primary keys: {e}")
+    finally:
+        pool.release(conn)
+
+    return schemas
+
+def getSnowflakeTableSchemas(tables, user, _private_key, account, warehouse, database, schema):
+    '''
+    The table metadata from loadSnowflakeTableSchemas, or None if Snowflake can't be reached
+    '''
+    try:
+        return loadSnowflakeTableSchemas(tables, user, _private_key, account, warehouse, database, schema)
+    except Exception as e:
+        print(f"Error fetching table metadata: {e}")
+        return None
+
+def formatTableDescription(table_schema):
+    description = f"Table: {table_schema['name']}\n"
+    if table_schema["comment"]:
+        description += f" Comment: {table_schema['comment']}\n"
+    description += f" Row Count: {table_schema['row_count']}\n"
+    for column in table_schema["columns"]:
+        description += (f' Column: "{column["name"]}", Type: {column["data_type"]}, Nullable: {column["nullable"]}, '
+                        f'Default: {column["default"]}, Primary Key: {column["primary_key"]}, '
+                        f'Comment: {column["comment"]}\n')
+    description += "---------------------------------------------------------------\n"
+    return description
+
+@st.cache_data(show_spinner=False, ttl=performance_settings["table_schema_ttl"])
+def describeSnowflakeTables(tables, user, _private_key, account, warehouse, database, schema):
+    schemas = loadSnowflakeTableSchemas(tables, user, _private_key, account, warehouse, database, schema)
+    return "".join(formatTableDescription(table_schema) for table_schema in schemas.values())
+
+def getSnowflakeTableDescriptions(tables, user, _private_key, account, warehouse, database, schema):
+    '''
+    The table descriptions for the prompts, or None if Snowflake can't be reached
+    '''
+    try:
+        return describeSnowflakeTables(tables, user, _private_key, account, warehouse, database, schema)
+    except Exception as e:
+        print(f"Error fetching table metadata: {e}")
+        return None
+
+# Row counts change with every load, so they are left out of the prompts whose answers are cached per table
+ROW_COUNT_LINE = re.compile(r'^ Row Count: .*\n', re.MULTILINE)
+
+def withoutRowCounts(description):
+    return ROW_COUNT_LINE.sub('', str(description))
+
+def suggestQuestion(description, refresh=False):
+    # description = "this is a test."
+    systemPrompt = st.secrets.prompts.suggest_a_question
+    suggestion = callDeployment("summarize_table", systemPrompt, withoutRowCounts(description), refresh=refresh)
     return suggestion
 
-@st.cache_data(show_spinner=False)
-def summarizeTable(dictionary, table):
+def summarizeTable(dictionary, table, refresh=False):
     systemPrompt = st.secrets.prompts.summarize_table
     systemPrompt = systemPrompt.format(table=table)
     # table = "This is a test"
     # dictionary = "this is a test dictionary."
-    data = pd.DataFrame(
-        {"systemPrompt": systemPrompt, "promptText": [str(dictionary) + "\nTABLE TO DESCRIBE: " + str(table)]})
-    deployment_id = st.secrets.datarobot_deployment_id.summarize_table
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    summary = predictions_response.json()["data"][0]["prediction"]
+    summary = callDeployment("summarize_table", systemPrompt,
+                             withoutRowCounts(dictionary) + "\nTABLE TO DESCRIBE: " + str(table), refresh=refresh)
     return summary
 
-@st.cache_data(show_spinner=False)
 def getDataDictionary(prompt):
     systemPrompt = st.secrets.prompts.get_data_dictionary
     # prompt = data
 
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.data_dictionary_maker
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
+    code = callDeployment("data_dictionary_maker", systemPrompt, prompt)
     return code
 
-@st.cache_data(show_spinner=False)
 def assembleDictionaryParts(parts):
     systemPrompt = st.secrets.prompts.assemble_data_dictionary
     # parts = data
 
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [parts]})
-    deployment_id = st.secrets.datarobot_deployment_id.data_dictionary_assembler
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    assembled = predictions_response.json()["data"][0]["prediction"]
+    assembled = callDeployment("data_dictionary_assembler", systemPrompt, parts)
     return assembled
-@st.cache_data(show_spinner=False)
+
+# Used when the secrets don't define prompts.get_column_descriptions
+COLUMN_DESCRIPTIONS_PROMPT = (
+    "You write data dictionaries. For every column listed, write one or two sentences describing what it holds, "
+    "in business terms, using the table description, column comments and sample rows as evidence. Reply with only "
+    "a JSON object that maps each column name, exactly as given, to its description.")
+
+class DictionaryStore:
+    '''
+    Column descriptions of Snowflake tables, kept in the cache database and shared by every session and process.
+    Each description is stored under (database, schema, table, column, data type), so a column whose type
+    changes is described again and every other column keeps its description.
+    '''
+
+    def __init__(self, database):
+        self.database = database
+        database.executescript("""
+            CREATE TABLE IF NOT EXISTS column_descriptions (
+                database_name TEXT NOT NULL,
+                schema_name TEXT NOT NULL,
+                table_name TEXT NOT NULL,
+                column_name TEXT NOT NULL,
+                data_type TEXT NOT NULL,
+                description TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (database_name, schema_name, table_name, column_name, data_type)
+            );
+            """)
+
+    def load(self, database, schema, table):
+        rows = self.database.execute(
+            "SELECT column_name, data_type, description FROM column_descriptions "
+            "WHERE database_name = ? AND schema_name = ? AND table_name = ?", (database, schema, table))
+        return {(column, data_type): description for column, data_type, description in rows}
+
+    def save(self, database, schema, table, columns, descriptions):
+        '''
+        Stores descriptions ({column: description}) for the given schema columns. Descriptions of columns the
+        table no longer has are left in place; prune removes those.
+        '''
+        now = time.time()
+        for column in columns:
+            if column["name"] in descriptions:
+                self.database.execute(
+                    "INSERT OR REPLACE INTO column_descriptions VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (database, schema, table, column["name"], column["data_type"], descriptions[column["name"]], now))
+
+    def prune(self, database, schema, table, columns):
+        current = {(column["name"], column["data_type"]) for column in columns}
+        for column, data_type in self.load(database, schema, table):
+            if (column, data_type) not in current:
+                self.database.execute(
+                    "DELETE FROM column_descriptions WHERE database_name = ? AND schema_name = ? AND table_name = ? "
+                    "AND column_name = ? AND data_type = ?", (database, schema, table, column, data_type))
+
+
+@st.cache_resource(show_spinner=False)
+def getDictionaryStore():
+    return DictionaryStore(getCacheDatabase())
+
+def describeColumns(table_schema, columns, sample=None):
+    '''
+    Asks the dictionary maker to describe the given columns of a table and returns {column: description}.
+    Columns the response leaves out are missing from the result and are asked for again next time.
+    '''
+    names = [column["name"] for column in columns]
+    column_list = "\n".join(
+        f"{column['name']} ({column['data_type']})" + (f": {column['comment']}" if column["comment"] else "")
+        for column in columns)
+    sample_columns = [name for name in names if sample is not None and name in sample.columns]
+    prompt = buildDeploymentPrompt("data_dictionary_maker", [
+        promptSection("Table", table_schema["name"] + (f": {table_schema['comment']}" if table_schema["comment"] else ""),
+                      required=True),
+        promptSection("Columns", column_list, required=True),
+        promptSection("Sample Rows", sample[sample_columns].head(10) if sample_columns else None, priority=1,
+                      max_rows=None),
+    ])
+    systemPrompt = st.secrets.prompts.get("get_column_descriptions", COLUMN_DESCRIPTIONS_PROMPT)
+    response = callDeployment("data_dictionary_maker", systemPrompt, prompt)
+
+    match = re.search(r'\{.*\}', response, re.DOTALL)
+    try:
+        descriptions = json.loads(match.group(0)) if match else {}
+    except json.JSONDecodeError:
+        print(f"The column descriptions for {table_schema['name']} were not valid JSON")
+        descriptions = {}
+    if not isinstance(descriptions, dict):
+        return {}
+    return {name: str(descriptions[name]).strip() for name in names if descriptions.get(name)}
+
+def getTableDictionary(table, _private_key, sample=None, selection=None):
+    '''
+    The data dictionary of a table as a list of {"Column", "Data Type", "Description"} rows, in column order.
+    Only columns that are new, or whose data type changed, since the dictionary was last stored are sent to the
+    LLM, in parallel chunks; everything else is served from the dictionary store.
+    selection is the list of tables the table was selected with. Its columns are then read from the metadata
+    already loaded for the whole selection rather than queried again.
+    '''
+    selection = list(selection) if selection is not None and table in selection else [table]
+    schemas = getSnowflakeTableSchemas(selection, user, _private_key, account, warehouse, database, schema)
+    if schemas is None:
+        return []
+    table_schema = schemas[table]
+    store = getDictionaryStore()
+    stored = store.load(database, schema, table)
+    stale = [column for column in table_schema["columns"] if (column["name"], column["data_type"]) not in stored]
+
+    if stale:
+        print(f"Describing {len(stale)} new or changed columns of {table}")
+        chunk_size = performance_settings["dictionary_chunk_columns"]
+        chunks = [stale[i:i + chunk_size] for i in range(0, len(stale), chunk_size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=performance_settings["dictionary_workers"]) as executor:
+            futures = [executor.submit(withScriptContext(describeColumns), table_schema, chunk, sample)
+                       for chunk in chunks]
+            for chunk, future in zip(chunks, futures):
+                try:
+                    store.save(database, schema, table, chunk, future.result())
+                except Exception as e:
+                    print(f"Could not describe columns of {table}: {e}")
+        store.prune(database, schema, table, table_schema["columns"])
+        stored = store.load(database, schema, table)
+
+    return [{"Column": column["name"], "Data Type": column["data_type"],
+             "Description": stored.get((column["name"], column["data_type"]), "")}
+            for column in table_schema["columns"]]
+
+def formatTableDictionary(table, dictionary):
+    lines = [f"Table {table}:", "| Column | Data Type | Description |", "| --- | --- | --- |"]
+    lines.extend(f"| {row['Column']} | {row['Data Type']} | {row['Description'].replace('|', '/')} |"
+                 for row in dictionary)
+    return "\n".join(lines)
 def getPythonCode(prompt):
     systemPrompt = st.secrets.prompts.get_python_code
     # prompt = "test"
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.python_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
+    code = callDeployment("python_code_generator", systemPrompt, prompt, store=False)
+    deferCachedResponse(code, "python_code_generator", systemPrompt, prompt, code)
     return code
+@st.cache_resource(show_spinner=False)
+def getCompiledCodeCache():
+    return codeSandbox.CompiledCodeCache(max_entries=performance_settings["code_cache_entries"],
+                                         banned_imports=performance_settings["code_banned_imports"])
+
+@st.cache_resource(show_spinner=False)
+def getCodeSandbox():
+    address_space_mb = performance_settings["sandbox_address_space_mb"]
+    return codeSandbox.SandboxPool(
+        size=performance_settings["sandbox_workers"],
+        wall_seconds=performance_settings["sandbox_wall_seconds"],
+        cpu_seconds=performance_settings["sandbox_cpu_seconds"],
+        max_rss_bytes=performance_settings["sandbox_max_rss_mb"] * 1_000_000,
+        address_space_bytes=address_space_mb * 1_000_000 if address_space_mb else None,
+        code_cache=getCompiledCodeCache(),
+    )
 @st.cache_data(show_spinner=False)
 def executePythonCode(prompt, df):
     '''
     Executes the Python Code generated by the LLM
     '''
     print("Generating code...")
-    pythonCode = getPythonCode(prompt)
-    print(pythonCode.replace("```python", "").replace("```", ""))
-    pythonCode = pythonCode.replace("```python", "").replace("```", "")
+    generatedCode = getPythonCode(prompt)
+    pythonCode = codeSandbox.normalizeCode(generatedCode)
+    print(pythonCode)
     print("Executing...")
-    function_dict = {}
-    exec(pythonCode, function_dict)  # execute the code created by our LLM
-    analyze_data = function_dict['analyze_data']  # get the function that our code created
-    results = analyze_data(df)
+    # Invalid code raises CodeValidationError here, before anything runs
+    if performance_settings["sandbox_enabled"]:
+        # Run the code created by our LLM in a sandbox worker, which gets its own copy of df. Uploads are read
+        # straight from their dataset store file rather than written out again for every run.
+        results = getCodeSandbox().run("analyze", pythonCode, "analyze_data", df=df,
+                                       df_path=getDatasetStore().pathOf(df))
+    else:
+        analyze_data = getCompiledCodeCache().function(pythonCode, "analyze_data")  # get the function that our code created
+        results = analyze_data(df.copy())  # df is shared with other sessions, so the generated code gets its own copy
+    if results is not None and not getattr(results, "empty", False):
+        confirmCachedResponse(generatedCode)
     return pythonCode, results
-@st.cache_data(show_spinner=False)
 def getSnowflakeSQL(prompt, warehouse=warehouse, database=database, schema=schema):
     systemPrompt = st.secrets.prompts.get_snowflake_sql
     systemPrompt = systemPrompt.format(warehouse=warehouse, database=database, schema=schema)
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [
-        str(prompt) + "\nSNOWFLAKE ENVIRONMENT:\nwarehouse = " + str(warehouse) + "\ndatabase = " + str(
-            database) + "\nschema = " + str(schema)]})
-    deployment_id = st.secrets.datarobot_deployment_id.sql_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
+    promptText = str(prompt) + "\nSNOWFLAKE ENVIRONMENT:\nwarehouse = " + str(warehouse) + "\ndatabase = " + str(
+        database) + "\nschema = " + str(schema)
+    code = callDeployment("sql_code_generator", systemPrompt, promptText, store=False)
     # Pattern to match code blocks that optionally start with ```python or just ```
     pattern = r'```(?:sql)?\n(.*?)```'
     matches = re.findall(pattern, code, re.DOTALL)
 
     # Join all matches into a single string, separated by two newlines
     sql_code = '\n\n'.join(matches)
+    deferCachedResponse(sql_code, "sql_code_generator", systemPrompt, promptText, code)
     return sql_code
-@st.cache_data(show_spinner=False)
-def executeSnowflakeQuery(prompt, user, _private_key, account, warehouse, database, schema):
+# String literals, quoted identifiers, comments, whitespace, or any other single character of a SQL statement
+SQL_TOKEN = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"]|\"\")*\"|--[^\n]*|//[^\n]*|/\*.*?\*/|\s+|.", re.DOTALL)
+
+def normalizeSQL(sql):
+    '''
+    Removes comments, collapses whitespace outside literals and drops trailing semicolons, so SQL that differs
+    only in layout gets the same text (and the same Snowflake result-cache entry)
+    '''
+    tokens = []
+    for token in SQL_TOKEN.findall(sql):
+        if token.startswith(("--", "//", "/*")) or token.isspace():
+            if tokens and tokens[-1] != " ":
+                tokens.append(" ")
+        else:
+            tokens.append(token)
+    return "".join(tokens).strip().rstrip(";").strip()
+
+def fetchBounded(cur, max_rows, max_bytes):
+    '''
+    Fetches the results of the query last run on cur as Arrow batches, stopping once max_rows rows or max_bytes
+    bytes have been read so the rest of the result is never downloaded. Returns a DataFrame whose attrs["fetch"]
+    records the total row count, how much was returned and whether the result was truncated.
+    '''
+    start = time.perf_counter()
+    batches = []
+    rows = 0
+    nbytes = 0
+    truncated = False
+    for batch in cur.fetch_arrow_batches():
+        if rows + batch.num_rows > max_rows:
+            batch = batch.slice(0, max_rows - rows)
+            truncated = True
+        if batch.num_rows and nbytes + batch.nbytes > max_bytes:
+            # Keep the share of the batch that fits, assuming its rows are of similar size
+            batch = batch.slice(0, int(batch.num_rows * (max_bytes - nbytes) / batch.nbytes))
+            truncated = True
+        batches.append(batch)
+        rows += batch.num_rows
+        nbytes += batch.nbytes
+        if truncated:
+            break
+
+    if batches:
+        results = pa.concat_tables(batches).to_pandas()
+    else:
+        # No rows: build an empty frame from the cursor description
+        results = pd.DataFrame(columns=[column[0] for column in cur.description])
+    results.columns = results.columns.str.upper()
+    total_rows = cur.rowcount if cur.rowcount is not None and cur.rowcount >= 0 else None
+    results.attrs["fetch"] = {
+        "total_rows": total_rows if total_rows is not None else len(results),
+        "returned_rows": len(results),
+        "returned_bytes": nbytes,
+        "truncated": truncated,
+        "fetch_seconds": round(time.perf_counter() - start, 3),
+    }
+    return results
+
+def describeTruncation(results):
+    '''
+    One-line note on a result fetched by fetchBounded, or None when it is complete
+    '''
+    fetch = getattr(results, "attrs", {}).get("fetch")
+    if not fetch or not fetch["truncated"]:
+        return None
+    return (f"Showing the first {fetch['returned_rows']:,} of {fetch['total_rows']:,} rows "
+            f"({fetch['returned_bytes'] / 1_000_000:,.1f} MB); the rest of the result was not fetched.")
+
+class QueryResultCache:
+    '''
+    Results of generated SQL, keyed on the normalized SQL text plus the LAST_ALTERED time of every table it reads,
+    so a cached result is only reused while the underlying data is unchanged. Results are kept as Arrow files in
+    the dataset store (shared by every session and process); when a file has been evicted, an expensive query
+    that ran in the last day is re-read from Snowflake's persisted results with RESULT_SCAN instead of re-run.
+    '''
+
+    def __init__(self, database, store, ttl, result_scan_min_seconds):
+        self.database = database
+        self.store = store
+        self.ttl = ttl
+        self.result_scan_min_seconds = result_scan_min_seconds
+        self.stats = {"hit": 0, "result_scan": 0, "miss": 0, "uncacheable": 0}
+        self._lock = threading.Lock()
+        database.executescript("""
+            CREATE TABLE IF NOT EXISTS query_results (
+                key TEXT PRIMARY KEY,
+                sql TEXT NOT NULL,
+                query_id TEXT,
+                execution_seconds REAL NOT NULL,
+                created_at REAL NOT NULL
+            );
+            """)
+
+    def record(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def key(self, cursor, sql, database, schema):
+        '''
+        Cache key for sql, or None when the result can't be cached (unknown tables or views, whose
+        LAST_ALTERED does not track their data)
+        '''
+        tables = sqlTables.referencedTables(sql, database, schema)
+        if not tables:
+            return None
+        versions = []
+        for table_database in sorted({table[0] for table in tables}):
+            names = [table for table in tables if table[0] == table_database]
+            conditions = " OR ".join(["(TABLE_SCHEMA = %s AND TABLE_NAME = %s)"] * len(names))
+            cursor.execute(f"""
+                SELECT TABLE_SCHEMA, TABLE_NAME, TABLE_TYPE, LAST_ALTERED
+                FROM {quoteIdentifier(table_database)}.INFORMATION_SCHEMA.TABLES
+                WHERE {conditions}
+                """, [part for table in names for part in table[1:]])
+            rows = cursor.fetchall()
+            if len(rows) != len(names) or any(row[2] != "BASE TABLE" for row in rows):
+                return None
+            versions.extend(f"{table_database}.{row[0]}.{row[1]}@{row[3]}" for row in rows)
+        return hashlib.sha256("\0".join([account, role, sql, *sorted(versions)]).encode()).hexdigest()
+
+    def get(self, cursor, key):
+        results = self.store.get(f"query:{key}", max_age=self.ttl)
+        if results is not None:
+            self.record("hit")
+            return results
+
+        # Snowflake keeps persisted results for 24 hours
+        rows = self.database.execute(
+            "SELECT query_id FROM query_results WHERE key = ? AND query_id IS NOT NULL AND created_at > ? "
+            "AND execution_seconds >= ?",
+            (key, time.time() - min(self.ttl, 23 * 60 * 60), self.result_scan_min_seconds))
+        if rows:
+            try:
+                cursor.execute("SELECT * FROM TABLE(RESULT_SCAN(%s))", [rows[0][0]])
+                results = fetchBounded(cursor, performance_settings["query_max_rows"],
+                                       performance_settings["query_max_mb"] * 1_000_000)
+                self.record("result_scan")
+                return self.store.put(f"query:{key}", results)
+            except snowflake.connector.errors.Error as e:
+                print(f"Could not reuse the result of query {rows[0][0]}: {e}")
+        self.record("miss")
+        return None
+
+    def put(self, key, sql, query_id, execution_seconds, results):
+        self.database.execute(
+            "INSERT OR REPLACE INTO query_results (key, sql, query_id, execution_seconds, created_at) "
+            "VALUES (?, ?, ?, ?, ?)", (key, sql, query_id, execution_seconds, time.time()))
+        self.database.execute("DELETE FROM query_results WHERE created_at <= ?", (time.time() - self.ttl,))
+        return self.store.put(f"query:{key}", results)
+
+    def statsRow(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+@st.cache_resource(show_spinner=False)
+def getQueryResultCache():
+    return QueryResultCache(getCacheDatabase(), getDatasetStore(), ttl=performance_settings["query_cache_ttl"],
+                            result_scan_min_seconds=performance_settings["query_cache_result_scan_min_seconds"])
+
+class SQLValidationError(ValueError):
+    '''
+    Generated SQL that was rejected before it ran. sql is the rejected statement.
+    '''
+
+    def __init__(self, message, sql):
+        super().__init__(message)
+        self.sql = sql
+
+
+def checkSQL(sql, database, schema):
+    '''
+    Parses sql and checks its table and column references against the table schemas, raising SQLValidationError
+    for anything Snowflake would refuse. Returns the parsed statement.
+    '''
+    try:
+        statements = [statement for statement in sqlglot.parse(sql, read="snowflake") if statement is not None]
+    except SqlglotError as e:
+        errors = getattr(e, "errors", None)
+        detail = f"{errors[0]['description']} (line {errors[0]['line']}, column {errors[0]['col']})" if errors else e
+        raise SQLValidationError(f"The SQL could not be parsed: {detail}", sql) from None
+    if len(statements) != 1:
+        raise SQLValidationError(f"Expected one SQL statement, found {len(statements)}.", sql)
+    tree = normalize_identifiers(statements[0], dialect="snowflake")
+    if not isinstance(tree, exp.Query):
+        raise SQLValidationError("Only SELECT queries can be run.", sql)
+
+    ctes = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+    tables = set()
+    other_tables = False
+    for table in tree.find_all(exp.Table):
+        if not isinstance(table.this, exp.Identifier) or (not table.db and table.name in ctes):
+            continue
+        if table.catalog not in ("", database.upper()) or table.db not in ("", schema.upper()):
+            other_tables = True  # Only the configured schema is checked
+            continue
+        tables.add(table.name)
+    if not tables:
+        return tree
+
+    schemas = getSnowflakeTableSchemas(sorted(tables), user, private_key, account, warehouse, database, schema)
+    if schemas is None:
+        return tree
+    missing = sorted(table for table in tables if not schemas[table]["columns"])
+    if missing:
+        raise SQLValidationError(f"Table {', '.join(missing)} does not exist or is not authorized in "
+                                 f"{database}.{schema}.", sql)
+    if other_tables:
+        return tree
+
+    mapping = {database.upper(): {schema.upper(): {
+        table: {column["name"]: column["data_type"] for column in table_schema["columns"]}
+        for table, table_schema in schemas.items()}}}
+    try:
+        qualify(tree.copy(), schema=mapping, catalog=database.upper(), db=schema.upper(), dialect="snowflake",
+                validate_qualify_columns=True, identify=False)
+    except OptimizeError as e:
+        if "could not be resolved" in str(e):
+            raise SQLValidationError(f"{e}. Use only the columns listed in the column definitions.", sql) from None
+        print(f"Skipping the column check: {e}")
+    except SqlglotError as e:
+        print(f"Skipping the column check: {e}")
+    return tree
+
+def explainSQL(cursor, sql):
+    '''
+    Snowflake's plan estimates for sql, from EXPLAIN (compiled but not run):
+    {"bytes_assigned", "partitions_assigned", "partitions_total"}
+    '''
+    cursor.execute("EXPLAIN USING JSON " + sql)
+    plan = json.loads(cursor.fetchone()[0])
+    stats = plan.get("GlobalStats", {})
+    return {"bytes_assigned": stats.get("bytesAssigned"), "partitions_assigned": stats.get("partitionsAssigned"),
+            "partitions_total": stats.get("partitionsTotal")}
+
+def validateSQL(cursor, sql, database, schema):
+    '''
+    Checks generated SQL before it runs: parse, table and column references, then EXPLAIN for the bytes it would
+    scan. Returns the plan {"sql", "bytes_assigned", "partitions_assigned", "partitions_total", "limited"}, where
+    sql may have gained a LIMIT; raises SQLValidationError with a message for the retry prompt otherwise.
+    '''
+    tree = checkSQL(sql, database, schema)
+    try:
+        plan = explainSQL(cursor, sql)
+    except snowflake.connector.errors.ProgrammingError as e:
+        # Compilation errors: the same message the query itself would have failed with
+        raise SQLValidationError(e.msg or str(e), sql) from None
+
+    plan.update({"sql": sql, "limited": False})
+    scan_gb = (plan["bytes_assigned"] or 0) / 1e9
+    if scan_gb > performance_settings["sql_reject_scan_gb"]:
+        raise SQLValidationError(
+            f"The query would scan about {scan_gb:,.0f} GB, over the {performance_settings['sql_reject_scan_gb']:,} GB "
+            f"limit. Filter on partitioning columns such as dates, or aggregate more selectively.", sql)
+    if scan_gb > performance_settings["sql_limit_scan_gb"] and not tree.args.get("limit") \
+            and not tree.args.get("fetch"):
+        plan["sql"] = f"{sql}\nLIMIT {performance_settings['sql_auto_limit_rows']}"
+        plan["limited"] = True
+        print(f"The query would scan about {scan_gb:,.0f} GB, limiting it to "
+              f"{performance_settings['sql_auto_limit_rows']} rows")
+    return plan
+
+class QueryRouter:
+    '''
+    Sends each class of query to its own warehouse with its own statement timeout, and tags it (QUERY_TAG, as
+    JSON) with its class plus the session, question and attempt it belongs to so credit spend can be attributed.
+    The settings applied to each pooled connection are remembered, so only what changed is sent.
+    '''
+
+    def __init__(self, warehouses, default_warehouse, timeouts, sample_max_bytes, app_tag):
+        self.warehouses = dict(warehouses)
+        self.default_warehouse = default_warehouse
+        self.timeouts = dict(timeouts)
+        self.sample_max_bytes = sample_max_bytes
+        self.app_tag = app_tag
+        self._applied = weakref.WeakKeyDictionary()  # connection -> settings it has
+        self._lock = threading.Lock()
+        self.stats = {"metadata": 0, "sample": 0, "analytical": 0, "settings_changed": 0}
+
+    def classify(self, plan):
+        if not plan or plan.get("bytes_assigned") is None:
+            return "analytical"
+        if not plan.get("partitions_total") and not plan["bytes_assigned"]:
+            return "metadata"
+        if plan["bytes_assigned"] <= self.sample_max_bytes:
+            return "sample"
+        return "analytical"
+
+    def apply(self, conn, query_class, tag=None):
+        '''
+        Points conn at the warehouse, statement timeout and query tag for query_class
+        '''
+        warehouse = self.warehouses.get(query_class, self.default_warehouse)
+        settings = {
+            "timeout": self.timeouts.get(query_class, 0),
+            "tag": json.dumps({"app": self.app_tag, "class": query_class, **(tag or {})}, sort_keys=True),
+        }
+        with self._lock:
+            applied = dict(self._applied.get(conn, {}))
+            self.stats[query_class] += 1
+        with conn.cursor() as cur:
+            if applied.get("warehouse") != warehouse:
+                cur.execute("USE WAREHOUSE IDENTIFIER(%s)", [warehouse])
+            if any(applied.get(name) != value for name, value in settings.items()):
+                cur.execute("ALTER SESSION SET QUERY_TAG = %s, STATEMENT_TIMEOUT_IN_SECONDS = %s",
+                            [settings["tag"], settings["timeout"]])
+        with self._lock:
+            if applied != {"warehouse": warehouse, **settings}:
+                self.stats["settings_changed"] += 1
+            self._applied[conn] = {"warehouse": warehouse, **settings}
+        return warehouse
+
+    def statsRow(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+@st.cache_resource(show_spinner=False)
+def getQueryRouter():
+    return QueryRouter(st.secrets.snowflake_credentials.get("warehouses", {}), warehouse,
+                       timeouts=performance_settings["query_class_timeouts"],
+                       sample_max_bytes=performance_settings["query_class_sample_max_gb"] * 1e9,
+                       app_tag=performance_settings["snowflake_session_parameters"].get("QUERY_TAG", "ai-data-analyst"))
+
+def routeQuery(conn, query_class, tag=None):
+    if performance_settings["query_router_enabled"]:
+        getQueryRouter().apply(conn, query_class, tag)
+
+def runQuery(conn, sql, database, schema, tag=None):
+    '''
+    Runs generated SQL on conn and returns its results (capped at the query_max_rows / query_max_mb budgets),
+    served from the query result cache when the data the query reads has not changed since it was cached.
+    SQL that fails validation raises SQLValidationError without running. The query runs on the warehouse of its
+    class, tagged with tag.
+    '''
+    sql = normalizeSQL(sql)
+    cache = getQueryResultCache() if performance_settings["query_cache_enabled"] else None
+    with conn.cursor() as cur:
+        key = None
+        if cache is not None:
+            try:
+                key = cache.key(cur, sql, database, schema)
+            except snowflake.connector.errors.Error as e:
+                print(f"Could not check table versions, not caching this query: {e}")
+            if key is None:
+                cache.record("uncacheable")
+            else:
+                results = cache.get(cur, key)
+                if results is not None:
+                    return results
+
+        plan = None
+        if performance_settings["sql_validation_enabled"]:
+            plan = validateSQL(cur, sql, database, schema)
+        elif performance_settings["query_router_enabled"]:
+            try:
+                plan = explainSQL(cur, sql)
+            except snowflake.connector.errors.Error as e:
+                print(f"Could not EXPLAIN the query, routing it as analytical: {e}")
+        run_sql = plan["sql"] if plan and "sql" in plan else sql
+        if performance_settings["query_router_enabled"]:
+            routeQuery(conn, getQueryRouter().classify(plan), tag)
+
+        start = time.perf_counter()
+        cur.execute(run_sql)
+        results = fetchBounded(cur, performance_settings["query_max_rows"],
+                               performance_settings["query_max_mb"] * 1_000_000)
+        if key is not None:
+            results = cache.put(key, sql, cur.sfqid, time.perf_counter() - start, results)
+    return results
+
+def executeSnowflakeQuery(prompt, user, _private_key, account, warehouse, database, schema, tag=None):
     # Get the SQL code
     snowflakeSQL = getSnowflakeSQL(prompt)
 
-    # Create a connection using Snowflake Connector
-    conn = snowflake.connector.connect(
-        user=user,
-        private_key=_private_key,
-        account=account,
-        warehouse=warehouse,
-        database=database,
-        schema=schema,
-        role=role,
-        # Enable case sensitivity for identifiers
-        case_sensitive_identifier_quoting=True
-    )
     results = None
 
+    # Check out a pooled connection, execute the query and fetch the results into a DataFrame
+    with getSnowflakePool(user, _private_key, account, warehouse, database, schema, role).checkout() as conn:
+        try:
+            results = runQuery(conn, snowflakeSQL, database, schema, tag=tag)
+        except snowflake.connector.errors.Error as e:
+            print(f"An error occurred: {e}")
+
+    if results is not None and not results.empty:
+        confirmCachedResponse(snowflakeSQL)
+    return snowflakeSQL, results
+# Appended to the prompt of each speculative candidate after the first, so each asks for a different approach
+# (and has its own response cache entry)
+SQL_CANDIDATE_HINTS = [
+    "",
+    "\nApproach: build the answer step by step with CTEs and explicit JOINs.",
+    "\nApproach: write the simplest query that answers the question, aggregating as early as possible.",
+    "\nApproach: be careful with NULLs, duplicates from joins and date boundaries.",
+    "\nApproach: use window functions where they avoid self-joins or correlated subqueries.",
+]
+
+def prepareSQLCandidate(prompt, hint, database, schema):
+    '''
+    Generates one candidate query and checks it: from the query result cache when it has a cached result,
+    otherwise with validateSQL. Returns {"sql", "plan", "key", "results", "error"}.
+    '''
+    candidate = {"generated": None, "sql": None, "plan": None, "key": None, "results": None, "error": None}
+    try:
+        candidate["generated"] = getSnowflakeSQL(prompt + hint)
+        candidate["sql"] = normalizeSQL(candidate["generated"])
+        with getSnowflakePool(user, private_key, account, warehouse, database, schema, role).checkout() as conn:
+            with conn.cursor() as cur:
+                cache = getQueryResultCache() if performance_settings["query_cache_enabled"] else None
+                if cache is not None:
+                    candidate["key"] = cache.key(cur, candidate["sql"], database, schema)
+                    if candidate["key"] is not None:
+                        candidate["results"] = cache.get(cur, candidate["key"])
+                        if candidate["results"] is not None:
+                            return candidate
+                if performance_settings["sql_validation_enabled"]:
+                    candidate["plan"] = validateSQL(cur, candidate["sql"], database, schema)
+                else:
+                    candidate["plan"] = explainSQL(cur, candidate["sql"])
+                    candidate["plan"]["sql"] = candidate["sql"]
+    except Exception as e:
+        candidate["error"] = e
+    return candidate
+
+def cancelQuery(conn, query_id):
     try:
-        # Execute the query and fetch the results into a DataFrame
         with conn.cursor() as cur:
-            cur.execute(snowflakeSQL)
-            results = cur.fetch_pandas_all()
-            results.columns = results.columns.str.upper()
+            cur.execute("SELECT SYSTEM$CANCEL_QUERY(%s)", [query_id])
     except snowflake.connector.errors.Error as e:
-        print(f"An error occurred: {e}")
+        print(f"Could not cancel query {query_id}: {e}")
+
+def raceQueries(candidates, database, schema, tag):
+    '''
+    Starts every candidate asynchronously on its own pooled connection and returns the first to finish with a
+    non-empty result, cancelling the rest by query ID. Candidates that fail or come back empty get an "error".
+    The race ends after the longest query class timeout even when the router (and so the statement timeout of
+    each query) is off; whatever is still running then is cancelled.
+    '''
+    pool = getSnowflakePool(user, private_key, account, warehouse, database, schema, role)
+    router = getQueryRouter() if performance_settings["query_router_enabled"] else None
+    deadline = time.monotonic() + max(performance_settings["query_class_timeouts"].values())
+    running = {}  # query ID -> (candidate, connection, start time)
+    winner = None
+    try:
+        for i, candidate in enumerate(candidates):
+            conn = None
+            try:
+                # A checkout timeout or failed connect loses this candidate, not the question
+                conn = pool.acquire()
+                if router is not None:
+                    router.apply(conn, router.classify(candidate["plan"]), {**(tag or {}), "candidate": i + 1})
+                with conn.cursor() as cur:
+                    cur.execute_async(candidate["plan"]["sql"])
+                    running[cur.sfqid] = (candidate, conn, time.perf_counter())
+            except Exception as e:
+                candidate["error"] = e
+                if conn is not None:
+                    pool.release(conn)
+
+        while running and winner is None:
+            if time.monotonic() >= deadline:
+                print(f"Speculative query deadline reached, cancelling {len(running)} running candidates")
+                break
+            time.sleep(performance_settings["sql_speculative_poll_seconds"])
+            for query_id, (candidate, conn, start) in list(running.items()):
+                try:
+                    if conn.is_still_running(conn.get_query_status(query_id)):
+                        continue
+                    conn.get_query_status_throw_if_error(query_id)
+                    with conn.cursor() as cur:
+                        cur.get_results_from_sfqid(query_id)
+                        candidate["results"] = fetchBounded(cur, performance_settings["query_max_rows"],
+                                                            performance_settings["query_max_mb"] * 1_000_000)
+                except snowflake.connector.errors.Error as e:
+                    candidate["error"] = e
+                del running[query_id]
+                pool.release(conn)
+                if candidate["results"] is not None and candidate["results"].empty:
+                    candidate["error"] = ValueError("The DataFrame is empty")
+                elif candidate["error"] is None:
+                    if candidate["key"] is not None:
+                        candidate["results"] = getQueryResultCache().put(
+                            candidate["key"], candidate["sql"], query_id, time.perf_counter() - start,
+                            candidate["results"])
+                    winner = candidate
+                    break
     finally:
-        conn.close()
+        for query_id, (candidate, conn, start) in running.items():
+            cancelQuery(conn, query_id)
+            if winner is not None:
+                reason = "another candidate answered first"
+            else:
+                reason = "the race timed out" if time.monotonic() >= deadline else "the race was stopped"
+            candidate["error"] = candidate["error"] or ValueError(f"Cancelled: {reason}")
+            pool.release(conn)
+    return winner
+
+def executeSpeculativeQuery(prompt, database, schema, tag=None):
+    '''
+    Asks the SQL deployment for several candidate queries at once, validates them, and races the most promising
+    (the SQL most candidates agree on first, then generation order) on Snowflake. Returns (sql, results) of the
+    winner, or (None, candidates) when none produced a non-empty result.
+    '''
+    hints = SQL_CANDIDATE_HINTS[:performance_settings["sql_speculative_candidates"]]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(hints)) as executor:
+        candidates = list(executor.map(
+            withScriptContext(lambda hint: prepareSQLCandidate(prompt, hint, database, schema)), hints))
+
+    for candidate in candidates:
+        if candidate["results"] is not None and not candidate["results"].empty:
+            confirmCachedResponse(candidate["generated"])
+            return candidate["sql"], candidate["results"]
+
+    # Identical SQL from different candidates is one query with more votes
+    votes = {}
+    for candidate in candidates:
+        if candidate["error"] is None and candidate["plan"] is not None:
+            votes.setdefault(candidate["sql"], []).append(candidate)
+    groups = sorted(votes.values(), key=len, reverse=True)
+    ranked = [group[0] for group in groups]
+    print(f"{len(ranked)} distinct valid SQL candidates of {len(candidates)}")
+
+    # A majority agreeing on one query is confidence enough to pay for that query alone
+    run = performance_settings["sql_speculative_run"]
+    if groups and len(groups[0]) * 2 > len(candidates):
+        run = 1
+    winner = raceQueries(ranked[:run], database, schema, tag)
+    if winner is not None:
+        confirmCachedResponse(winner["generated"])
+        return winner["sql"], winner["results"]
+    return None, candidates
 
-    return snowflakeSQL, results
-@st.cache_data(show_spinner=False)
 def getSnowflakePython(prompt, warehouse=warehouse, database=database, schema=schema):
     systemPrompt = st.secrets.prompts.get_snowflake_snowpark
     systemPrompt = systemPrompt.format(warehouse=warehouse, database=database, schema=schema)
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [
-        str(prompt) + "\nSNOWFLAKE ENVIRONMENT:\nwarehouse = " + str(warehouse) + "\ndatabase = " + str(
-            database) + "\nschema = " + str(schema)]})
-    deployment_id = st.secrets.datarobot_deployment_id.sql_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
+    promptText = str(prompt) + "\nSNOWFLAKE ENVIRONMENT:\nwarehouse = " + str(warehouse) + "\ndatabase = " + str(
+        database) + "\nschema = " + str(schema)
+    code = callDeployment("sql_code_generator", systemPrompt, promptText, store=False)
     # Pattern to match code blocks that optionally start with ```python or just ```
     pattern = r'```(?:python)?\n(.*?)```'
     matches = re.findall(pattern, code, re.DOTALL)
 
     # Join all matches into a single string, separated by two newlines
     snowpark_code = '\n\n'.join(matches)
+    deferCachedResponse(snowpark_code, "sql_code_generator", systemPrompt, promptText, code)
     return snowpark_code
 @st.cache_data(show_spinner=False)
 def executeSnowflakeSnowpark(prompt, user, _private_key, account, warehouse, database, schema, role):
-    from snowflake.snowpark import Session
-    import snowflake.snowpark.functions as F
-
     # Get the Snowpark Python DataFrame transformation as a string
-    snowflake_df_transform = getSnowflakePython(prompt)
+    generatedCode = getSnowflakePython(prompt)
+    snowflake_df_transform = codeSandbox.normalizeCode(generatedCode)
+    transform_code = "import pandas as pd\nimport snowflake.snowpark.functions as F\n" + snowflake_df_transform
 
     print("SNOWPARK CODE\n================")
     print(snowflake_df_transform)
 
-    # Define connection parameters
-    connection_parameters = {
-        "account": account,
-        "user": user,
-        "private_key": _private_key,
-        "role": role,
-        "warehouse": warehouse,
-        "database": database,
-        "schema": schema
-    }
+    if performance_settings["sandbox_enabled"]:
+        # The sandbox worker keeps its own Snowpark session, built from these parameters
+        connection_parameters = {
+            "account": account,
+            "user": user,
+            "private_key": _private_key.private_bytes(
+                encoding=serialization.Encoding.DER,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption(),
+            ),
+            "role": role,
+            "warehouse": warehouse,
+            "database": database,
+            "schema": schema
+        }
+        results = None
+        try:
+            results = getCodeSandbox().run("snowpark", transform_code, "transform_df", snowflake=connection_parameters)
+            results.columns = results.columns.str.upper()
+            confirmCachedResponse(generatedCode)
+        except codeSandbox.SandboxError as e:
+            print(f"An error occurred: {e}")
+        return snowflake_df_transform, results
 
-    # Create a Snowflake session
-    session = Session.builder.configs(connection_parameters).create()
+    # Reject invalid code before a session is checked out
+    try:
+        transform_df = getCompiledCodeCache().function(transform_code, "transform_df")
+    except codeSandbox.CodeValidationError as e:
+        print(f"An error occurred: {e}")
+        return snowflake_df_transform, None
+
+    # Check out a pooled Snowflake session
+    pool = getSnowparkPool(user, _private_key, account, warehouse, database, schema, role)
+    session = pool.acquire()
     results = None
 
     try:
-        # Combine the imports and the transform function in one execution block
-        exec(snowflake_df_transform, globals(), locals())
-
-        # Assume the code defines a function called 'transform_df' that takes a session
-        if 'transform_df' in locals():
-            df = locals()['transform_df'](session)
-        else:
-            raise ValueError("The code did not define a 'transform_df' function.")
+        # The code defines a function called 'transform_df' that takes a session
+        df = transform_df(session)
 
         # Convert the Snowpark DataFrame to a Pandas DataFrame
         results = df.to_pandas()
         results.columns = results.columns.str.upper()
+        confirmCachedResponse(generatedCode)
     except Exception as e:
         print(f"An error occurred: {e}")
     finally:
-        session.close()
+        pool.release(session)
 
     return snowflake_df_transform, results
 
-@st.cache_data(show_spinner=False)
+# Table names accepted by the sampling templates: NAME, SCHEMA.NAME or DATABASE.SCHEMA.NAME, each part optionally quoted
+SNOWFLAKE_TABLE_NAME = re.compile(
+    r'^(?:[A-Za-z_][A-Za-z0-9_$]*|"(?:[^"]|"")+")(?:\.(?:[A-Za-z_][A-Za-z0-9_$]*|"(?:[^"]|"")+")){0,2}$')
+
+def quoteIdentifier(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+def buildSampleSQL(table, sampleSize=None, method="rows", percent=None, seed=None, columns=None, stratifyBy=None):
+    '''
+    Builds a Snowflake sampling query from a template, without asking the LLM.
+    method "rows" takes a fixed-size sample of sampleSize rows. "bernoulli" keeps each row with probability
+    percent, and "system" keeps whole micro-partitions (faster, but clumpier); both accept a seed and an
+    optional sampleSize cap. stratifyBy takes sampleSize rows spread across the values of that column in
+    proportion to their frequency. columns limits the projection.
+    '''
+    if not SNOWFLAKE_TABLE_NAME.match(str(table)):
+        raise ValueError(f"Not a valid Snowflake table name: {table}")
+    projection = ", ".join(quoteIdentifier(column) for column in columns) if columns else "*"
+
+    if stratifyBy is not None:
+        if not sampleSize:
+            raise ValueError("Stratified sampling needs a sampleSize")
+        stratum = quoteIdentifier(stratifyBy)
+        random_order = f"RANDOM({int(seed)})" if seed is not None else "RANDOM()"
+        return (f"SELECT {projection} FROM {table} "
+                f"QUALIFY ROW_NUMBER() OVER (PARTITION BY {stratum} ORDER BY {random_order}) "
+                f"<= CEIL({int(sampleSize)} * COUNT(*) OVER (PARTITION BY {stratum}) / COUNT(*) OVER ())")
+
+    if method == "rows":
+        if not sampleSize:
+            raise ValueError("Row sampling needs a sampleSize")
+        if seed is not None:
+            raise ValueError("Snowflake can only seed bernoulli or system samples")
+        return f"SELECT {projection} FROM {table} SAMPLE ({int(sampleSize)} ROWS)"
+
+    if method not in ("bernoulli", "system"):
+        raise ValueError(f"Unknown sampling method: {method}")
+    if percent is None or not 0 < float(percent) <= 100:
+        raise ValueError("Bernoulli and system sampling need a percent between 0 and 100")
+    sql = f"SELECT {projection} FROM {table} SAMPLE {method.upper()} ({float(percent):g})"
+    if seed is not None:
+        sql += f" SEED ({int(seed)})"
+    if sampleSize:
+        sql += f" LIMIT {int(sampleSize)}"
+    return sql
+
+def runSampleQuery(sql):
+    # Fetch through Arrow rather than row by row
+    # Uses the app's key rather than the session's so the warm-up job can sample without a session
+    with getSnowflakePool(user, private_key, account, warehouse, database, schema, role).checkout() as conn:
+        routeQuery(conn, "sample")
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            table = cur.fetch_arrow_all()
+            if table is None:
+                # No rows: fetch_arrow_all returns None, so build an empty frame from the cursor description
+                results = pd.DataFrame(columns=[column[0] for column in cur.description])
+            else:
+                results = table.to_pandas()
+    results.columns = results.columns.str.upper()
+    return results
+
 def getDataSample(sampleSize):
-    sampleSQLprompt = f"""
-                      Select a {sampleSize} row random sample using the SAMPLE clause                
-                      """
-    sampleSQL = getSnowflakeSQL(sampleSQLprompt)
-
-    sql, sample = executeSnowflakeQuery(sampleSQL, user, st.session_state["private_key"], account, warehouse, database,
-                                        schema)
-    return sample
-@st.cache_data(show_spinner=False)
-def getTableSample(sampleSize, table):
-    sqlCode, results = executeSnowflakeQuery(
-        f"Retrieve a random sample using SAMPLE({sampleSize} ROWS) from this table: " + str(table), user,
-        st.session_state["private_key"], account, warehouse, database, schema)
+    # A sample of the first selected table
+    return getTableSample(sampleSize, st.session_state["selectedTables"][0])
+def getTableSample(sampleSize, table, method="rows", percent=None, seed=None, columns=None, stratifyBy=None,
+                   refresh=False):
+    sql = buildSampleSQL(table, sampleSize=sampleSize, method=method, percent=percent, seed=seed, columns=columns,
+                         stratifyBy=stratifyBy)
+    # Samples are kept in the dataset store, keyed on where they came from and how they were drawn
+    key = f"sample:{account}/{database}/{schema}:{sql}"
+    store = getDatasetStore()
+    results = None if refresh else store.get(key, max_age=performance_settings["dataset_sample_ttl"])
+    if results is None:
+        print(f"Sampling {table}: {sql}")
+        results = store.put(key, runSampleQuery(sql))
     return results
-@st.cache_data(show_spinner=False)
+def promptSection(label, content, priority=0, required=False, max_rows="default"):
+    return promptBuilder.PromptSection(
+        label, content, priority=priority, required=required,
+        max_rows=performance_settings["prompt_frame_max_rows"] if max_rows == "default" else max_rows,
+        max_columns=performance_settings["prompt_frame_max_columns"])
+
+def buildDeploymentPrompt(deployment, sections):
+    '''
+    Joins prompt sections, shrinking the least important ones until the prompt fits the deployment's token budget
+    '''
+    return promptBuilder.buildPrompt(sections, performance_settings["prompt_token_budgets"][deployment],
+                                     encoding=performance_settings["prompt_tokenizer_encoding"])
+
 def getChartCode(prompt):
     systemPrompt = st.secrets.prompts.get_chart_code
     # prompt = "test"
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.plotly_code_generator
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    code = predictions_response.json()["data"][0]["prediction"]
+    code = callDeployment("plotly_code_generator", systemPrompt, prompt, store=False)
     # Pattern to match code blocks that optionally start with ```python or just ```
     pattern = r'```(?:python)?\n(.*?)```'
     matches = re.findall(pattern, code, re.DOTALL)
 
     # Join all matches into a single string, separated by two newlines
     chart_code = '\n\n'.join(matches)
+    deferCachedResponse(chart_code, "plotly_code_generator", systemPrompt, prompt, code)
     return chart_code
 @st.cache_data(show_spinner=False)
 def createCharts(prompt, results):
     print("getting chart code...")
-    chartCode = getChartCode(prompt + str(results))
-    print(chartCode.replace("```python", "").replace("```", ""))
-    function_dict = {}
-    exec(chartCode.replace("```python", "").replace("```", ""), function_dict)  # execute the code created by our LLM
+    generatedCode = getChartCode(buildDeploymentPrompt("plotly_code_generator", [
+        promptSection(None, prompt, required=True),
+        promptSection("Data", results, priority=1),
+    ]))
+    chartCode = codeSandbox.normalizeCode(generatedCode)
+    print(chartCode)
     print("executing chart code...")
-    create_charts = function_dict['create_charts']  # get the function that our code created
-    fig1, fig2 = create_charts(results)
+    if performance_settings["sandbox_enabled"]:
+        # Run the code created by our LLM in a sandbox worker; the figures come back as plotly JSON
+        fig1_json, fig2_json = getCodeSandbox().run(
+            "charts", chartCode, "create_charts", df=results,
+            wall_seconds=performance_settings["sandbox_chart_wall_seconds"])
+        fig1, fig2 = pio.from_json(fig1_json), pio.from_json(fig2_json)
+    else:
+        create_charts = getCompiledCodeCache().function(chartCode, "create_charts")  # get the function that our code created
+        fig1, fig2 = create_charts(results)
+    confirmCachedResponse(generatedCode)
     return fig1, fig2
-@st.cache_data(show_spinner=False)
 def getBusinessAnalysis(prompt):
     systemPrompt = st.secrets.prompts.get_business_analysis
-    data = pd.DataFrame({"systemPrompt": systemPrompt, "promptText": [prompt]})
-    deployment_id = st.secrets.datarobot_deployment_id.business_analysis
-    API_URL = f'{st.secrets.datarobot_credentials.PREDICTION_SERVER}/predApi/v1.0/deployments/{deployment_id}/predictions'
-    API_KEY = st.secrets.datarobot_credentials.API_KEY
-    DATAROBOT_KEY = st.secrets.datarobot_credentials.DATAROBOT_KEY
-    headers = {
-        'Content-Type': 'application/json; charset=UTF-8',
-        'Authorization': 'Bearer {}'.format(API_KEY),
-        'DataRobot-Key': DATAROBOT_KEY,
-    }
-    url = API_URL.format(deployment_id=deployment_id)
-    predictions_response = requests.post(
-        url,
-        data=data.to_json(orient='records'),
-        headers=headers
-    )
-    business_analysis = predictions_response.json()["data"][0]["prediction"]
+    business_analysis = callDeployment("business_analysis", systemPrompt, prompt)
     return business_analysis
-@st.cache_data(show_spinner=False)
-def get_top_frequent_values(df):
-    # Select non-numeric columns
-    non_numeric_cols = df.select_dtypes(exclude=['number']).columns
+@st.cache_resource(show_spinner=False)
+def getFingerprintMemo():
+    '''
+    Fingerprints of live DataFrames, keyed by id(frame): (weak reference, shape and columns, fingerprint)
+    '''
+    return {"lock": threading.Lock(), "entries": {}}
 
-    # Prepare a list to store the results
-    results = []
+def fingerprintDataFrame(df):
+    '''
+    Content hash of a DataFrame: shape, column names, dtypes, index and values.
+    Remembered per frame object, so a frame that is profiled and prompted on every rerun is hashed once.
+    '''
+    memo = getFingerprintMemo()
+    signature = (df.shape, tuple(df.columns))
+    with memo["lock"]:
+        entry = memo["entries"].get(id(df))
+    if entry is not None and entry[0]() is df and entry[1] == signature:
+        return entry[2]
+    fingerprint = hashDataFrame(df)
+
+    def forget(ref, key=id(df)):
+        with memo["lock"]:
+            if memo["entries"].get(key, (None,))[0] is ref:
+                del memo["entries"][key]
+    with memo["lock"]:
+        memo["entries"][id(df)] = (weakref.ref(df, forget), signature, fingerprint)
+    return fingerprint
+
+def hashDataFrame(df):
+    hasher = hashlib.sha1()
+    hasher.update(repr((df.shape, list(df.columns), [str(dtype) for dtype in df.dtypes])).encode())
+    try:
+        hashes = pd.util.hash_pandas_object(df, index=True)
+    except TypeError:
+        # Unhashable cells (lists, dicts...) are hashed by their text instead
+        hashes = pd.util.hash_pandas_object(df.astype(str), index=True)
+    hasher.update(hashes.values.tobytes())
+    return hasher.hexdigest()
+
+def computeDataProfile(df, top_k=10):
+    '''
+    Profiles every column of df: null rate, distinct count, top-k values, min/max and quartiles.
+    Each column is factorized once and its value counts come from a bincount over the codes, so the cost
+    is a single pass per column. Numeric aggregates are computed for all numeric columns together.
+    '''
+    numeric = df.select_dtypes(include=['number'])
+    numeric_stats = numeric.agg(['min', 'max']).T if not numeric.empty else pd.DataFrame()
+    quartiles = numeric.quantile([0.25, 0.5, 0.75]).T if not numeric.empty else pd.DataFrame()
+
+    rows = []
+    row_count = len(df)
+    for col in df.columns:
+        series = df[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+        else:
+            try:
+                codes, uniques = pd.factorize(series)
+            except TypeError:
+                codes, uniques = pd.factorize(series.astype(str))
+        present = codes[codes >= 0]
+        counts = np.bincount(present, minlength=len(uniques))
+        if len(counts) > top_k:
+            top = np.argpartition(-counts, top_k)[:top_k]
+        else:
+            top = np.arange(len(counts))
+        top = top[np.argsort(-counts[top], kind='stable')]
+
+        row = {
+            'Column': col,
+            'Type': str(series.dtype),
+            'Null Rate': (row_count - len(present)) / row_count if row_count else 0.0,
+            'Distinct': int((counts > 0).sum()),
+            'Top Values': [str(uniques[i]) for i in top if counts[i] > 0],
+            'Min': None,
+            'Max': None,
+            '25%': None,
+            '50%': None,
+            '75%': None,
+        }
+        if col in numeric_stats.index:
+            row.update({'Min': numeric_stats.at[col, 'min'], 'Max': numeric_stats.at[col, 'max'],
+                        '25%': quartiles.at[col, 0.25], '50%': quartiles.at[col, 0.5], '75%': quartiles.at[col, 0.75]})
+        elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+            row.update({'Min': series.min(), 'Max': series.max()})
+        rows.append(row)
 
-    # Iterate over non-numeric columns
-    for col in non_numeric_cols:
-        # Find top 10 most frequent values for the column
-        top_values = df[col].value_counts().head(10).index.tolist()
+    return pd.DataFrame(rows)
 
-        # Convert the values to strings
-        top_values = [str(value) for value in top_values]
+@st.cache_data(show_spinner=False, max_entries=performance_settings["profile_cache_entries"])
+def getDataProfileForFingerprint(fingerprint, _df, top_k):
+    return computeDataProfile(_df, top_k)
 
-        # Append the column name and its frequent values to the results
-        results.append({'Non-numeric column name': col, 'Frequent Values': top_values})
+def getDataProfile(df, top_k=10):
+    '''
+    Memoized computeDataProfile, keyed on the content fingerprint of df
+    '''
+    return getDataProfileForFingerprint(fingerprintDataFrame(df), df, top_k)
 
-    # Create a new DataFrame for the results
-    result_df = pd.DataFrame(results)
+def get_top_frequent_values(df):
+    profile = getDataProfile(df)
+    # Non-numeric columns and their top 10 most frequent values, as strings
+    non_numeric_cols = set(df.select_dtypes(exclude=['number']).columns)
+    results = [{'Non-numeric column name': row['Column'], 'Frequent Values': row['Top Values']}
+               for _, row in profile.iterrows() if row['Column'] in non_numeric_cols]
+    return pd.DataFrame(results)
+
+class DatasetStore:
+    '''
+    Local store of datasets as uncompressed Arrow IPC files, shared by every session and process on the host.
+    Files are memory-mapped when read, so numeric columns are zero-copy views of the page cache and every
+    session of this process shares the same loaded frame. Least recently used files are removed once the
+    store exceeds its disk budget, and loaded frames are dropped once they exceed the memory budget.
+    '''
 
-    return result_df
+    def __init__(self, directory, disk_budget_bytes, memory_budget_bytes):
+        self.directory = directory
+        self.disk_budget_bytes = disk_budget_bytes
+        self.memory_budget_bytes = memory_budget_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._loaded = OrderedDict()  # key -> (frame, bytes, file modified time), most recently used last
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".arrow")
+
+    def put(self, key, df):
+        '''
+        Stores df under key and returns the frame callers should use from then on: the memory-mapped copy
+        when it could be written, otherwise df itself
+        '''
+        path = self.path(key)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with pa.OSFile(tmp_path, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_path, path)  # atomic, so readers never see a partial file
+        except (pa.ArrowException, OSError) as e:
+            print(f"Dataset store: keeping {key} in memory only, it could not be written: {e}")
+            self._remember(key, df, int(df.memory_usage(deep=True).sum()), time.time())
+            return df
+        with self._lock:
+            self._loaded.pop(key, None)  # so the file just written is read back, not the frame it replaced
+        self._evictFromDisk()
+        stored = self.get(key)
+        return stored if stored is not None else df
+
+    def pathOf(self, df):
+        '''
+        The Arrow file df was loaded from, while it is still on disk unchanged, otherwise None
+        '''
+        with self._lock:
+            found = [(key, entry[2]) for key, entry in self._loaded.items() if entry[0] is df]
+        if not found:
+            return None
+        key, modified = found[0]
+        path = self.path(key)
+        try:
+            return path if os.path.getmtime(path) == modified else None
+        except OSError:
+            return None
 
-# Function that creates the charts and business analysis
-@st.cache_data(show_spinner=False)
-def createChartsAndBusinessAnalysis(businessQuestion, results, prompt):
-    attempt_count = 0
-    max_attempts = 6
-    fig1 = fig2 = None
-    analysis = None
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        while attempt_count < max_attempts:
-            chart_future = executor.submit(createCharts, businessQuestion, results)
-            analysis_future = executor.submit(getBusinessAnalysis, prompt + str(results))
+    def get(self, key, max_age=None):
+        '''
+        The frame stored under key, or None when there is none or it was stored more than max_age seconds ago
+        '''
+        path = self.path(key)
+        try:
+            modified = os.path.getmtime(path)
+        except OSError:
+            modified = None  # Never written, or evicted from disk; a frame already loaded is still valid
+
+        with self._lock:
+            entry = self._loaded.get(key)
+            # A loaded frame is only reused while the file is the one it was read from
+            if entry is not None and modified not in (None, entry[2]):
+                del self._loaded[key]
+                entry = None
+            if entry is not None:
+                if max_age is not None and time.time() - entry[2] > max_age:
+                    del self._loaded[key]
+                    return None
+                self._loaded.move_to_end(key)
+                return entry[0]
+
+        if modified is None or (max_age is not None and time.time() - modified > max_age):
+            return None
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        except (OSError, pa.ArrowException) as e:  # Evicted or replaced by another process since the stat
+            print(f"Dataset store: could not read {key}: {e}")
+            return None
+        df = table.to_pandas(split_blocks=True)
+        try:
+            os.utime(path, (time.time(), modified))  # access time drives disk eviction, modified time drives max_age
+        except OSError:
+            pass
+        self._remember(key, df, table.nbytes, modified)
+        return df
+
+    def _remember(self, key, df, nbytes, modified):
+        with self._lock:
+            self._loaded[key] = (df, nbytes, modified)
+            self._loaded.move_to_end(key)
+            total = sum(entry[1] for entry in self._loaded.values())
+            while total > self.memory_budget_bytes and len(self._loaded) > 1:
+                _, (_, size, _) = self._loaded.popitem(last=False)
+                total -= size
+
+    def _evictFromDisk(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".arrow"):
+                continue
             try:
-                if fig1 is None or fig2 is None:
-                    fig1, fig2 = chart_future.result(timeout=30)  # Add a timeout for better handling
-                    with st.expander(label="Charts", expanded=True):
-                        st.plotly_chart(fig1, theme="streamlit", use_container_width=True)
-                        st.plotly_chart(fig2, theme="streamlit", use_container_width=True)
-                break  # If operation succeeds, break out of the loop
-            except Exception as e:
-                attempt_count += 1
-                print(f"Chart Attempt {attempt_count} failed with error: {repr(e)}")
-                fig1_str = str(fig1) if fig1 is not None else "None"
-                fig2_str = str(fig2) if fig2 is not None else "None"
-                businessQuestion += f"\nCHART CODE FAILED!  Attempt {attempt_count} failed with error: {repr(e)}\nFig1: {fig1_str}\nFig2: {fig2_str}"
-
-                if attempt_count >= max_attempts:
-                    print("Max charting attempts reached, handling the failure.")
-                    st.write("I was unable to plot the data.")
-                    # Handle the failure after the final attempt
-                else:
-                    print("Retrying the charts...")
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.disk_budget_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+    def statsRow(self):
+        with self._lock:
+            loaded = len(self._loaded)
+            memory = sum(entry[1] for entry in self._loaded.values())
+        files = [name for name in os.listdir(self.directory) if name.endswith(".arrow")]
+        disk = sum(os.path.getsize(os.path.join(self.directory, name)) for name in files)
+        return {"files": len(files), "disk_mb": disk / 1e6, "loaded": loaded, "memory_mb": memory / 1e6}
+
+
+@st.cache_resource(show_spinner=False)
+def getDatasetStore():
+    return DatasetStore(performance_settings["dataset_store_dir"],
+                        performance_settings["dataset_store_disk_budget_mb"] * 1_000_000,
+                        performance_settings["dataset_store_memory_budget_mb"] * 1_000_000)
+
+def inferCSVDtypes(sample):
+    '''
+    Picks read_csv dtypes from a sample of the file: low-cardinality text columns become categoricals
+    '''
+    dtypes = {}
+    for col in sample.select_dtypes(include=['object', 'string']).columns:
+        n_unique = sample[col].nunique(dropna=True)
+        if (n_unique <= performance_settings["csv_category_max_unique"]
+                and n_unique <= performance_settings["csv_category_max_ratio"] * max(len(sample), 1)):
+            dtypes[col] = 'category'
+    return dtypes
+
+def downcastNumerics(df):
+    for col in df.select_dtypes(include=['integer']).columns:
+        df[col] = pd.to_numeric(df[col], downcast='integer')
+    if performance_settings["csv_downcast_floats"]:
+        # pandas only downcasts to float32 when the values survive the round trip
+        for col in df.select_dtypes(include=['floating']).columns:
+            df[col] = pd.to_numeric(df[col], downcast='float')
+    return df
+
+def concatCSVChunks(chunks):
+    if len(chunks) == 1:
+        return chunks[0]
+    # Give each categorical column the same categories in every chunk, otherwise concat falls back to object
+    for col in chunks[0].columns:
+        if all(isinstance(chunk[col].dtype, pd.CategoricalDtype) for chunk in chunks):
+            categories = chunks[0][col].cat.categories
+            for chunk in chunks[1:]:
+                categories = categories.append(chunk[col].cat.categories).unique()
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def ingestCSV(content_hash, content):
+    '''
+    Parses an uploaded CSV into a compact DataFrame: dtypes are inferred from a sample, low-cardinality text
+    becomes categorical and numerics are downcast. Parsing uses the pyarrow engine when it is enabled and
+    installed, otherwise the file is read in chunks so peak memory stays close to the size of the result.
+    '''
+    start = time.perf_counter()
+    sample = pd.read_csv(io.BytesIO(content), nrows=performance_settings["csv_dtype_sample_rows"])
+    dtypes = inferCSVDtypes(sample)
+
+    if performance_settings["csv_use_pyarrow"] and importlib.util.find_spec("pyarrow") is not None:
+        df = downcastNumerics(pd.read_csv(io.BytesIO(content), engine='pyarrow', dtype=dtypes))
+    else:
+        chunks = [downcastNumerics(chunk) for chunk in
+                  pd.read_csv(io.BytesIO(content), dtype=dtypes, chunksize=performance_settings["csv_chunk_rows"])]
+        df = concatCSVChunks(chunks) if chunks else sample.iloc[0:0]
+
+    print(f"Ingested CSV {content_hash[:12]}: {len(df)} rows, {df.memory_usage(deep=True).sum() / 1e6:.1f} MB in "
+          f"memory, {time.perf_counter() - start:.2f}s")
+    return df
+
+def loadUploadedCSV(upload):
+    # Hash the upload once per file, not on every rerun
+    file_id = getattr(upload, "file_id", None) or getattr(upload, "id", None)
+    if file_id is None or st.session_state.get("csvFileId") != file_id:
+        st.session_state["csvFileId"] = file_id
+        st.session_state["csvContentHash"] = hashlib.sha256(upload.getvalue()).hexdigest()
+    # Parsed uploads live in the dataset store, shared between sessions, so callers must not modify the frame
+    key = f"csv:{st.session_state['csvContentHash']}"
+    store = getDatasetStore()
+    df = store.get(key)
+    if df is None:
+        df = store.put(key, ingestCSV(st.session_state["csvContentHash"], upload.getvalue()))
+    return df
+
+def streamBusinessAnalysis(prompt):
+    '''
+    Yields the business analysis as it is generated.
+    The OpenAI client streams tokens; DataRobot deployments return the whole analysis at once.
+    '''
+    model = performance_settings["business_analysis_openai_model"]
+    if openAImode and model:
+        systemPrompt = st.secrets.prompts.get_business_analysis
+        cached = lookupCachedResponse(f"openai_business_analysis:{model}", systemPrompt, prompt)
+        if cached is not None:
+            yield cached
+            return
+        stream = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": systemPrompt},
+                {"role": "user", "content": prompt},
+            ],
+            stream=True,
+        )
+        tokens = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                tokens.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        storeCachedResponse(f"openai_business_analysis:{model}", systemPrompt, prompt, "".join(tokens))
+    else:
+        yield getBusinessAnalysis(prompt)
+
+def summarizeError(error, limit=300):
+    '''
+    The error as one line of at most limit characters, for retry feedback
+    '''
+    text = " | ".join(line.strip() for line in f"{type(error).__name__}: {error}".splitlines() if line.strip())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
 
+def createChartsWithRetries(businessQuestion, results, deadline=None):
+    '''
+    Asks for chart code until it runs, up to chart_max_attempts times or until the deadline (a time.monotonic()
+    value) passes. Each retry carries a one-line summary of only the latest failures.
+    '''
+    failures = []
+    for attempt in range(1, performance_settings["chart_max_attempts"] + 1):
+        feedback = "".join(f"\nCHART CODE FAILED! Attempt {number}: {summary}"
+                           for number, summary in failures[-performance_settings["chart_feedback_attempts"]:])
         try:
-            with st.expander(label="Business Analysis", expanded=True):
-                analysis = analysis_future.result(timeout=30)  # Add a timeout for better handling
-                st.markdown(analysis.replace("$", "\$"))
-        except:
-            st.write("I am unable to provide the analysis. Please rephrase the question and try again.")
+            return createCharts(businessQuestion + feedback, results)
+        except Exception as e:
+            print(f"Chart Attempt {attempt} failed with error: {repr(e)}")
+            failures.append((attempt, summarizeError(e)))
+        if deadline is not None and time.monotonic() >= deadline:
+            print("Chart deadline reached, handling the failure.")
+            break
+    else:
+        print("Max charting attempts reached, handling the failure.")
+    return None, None
 
-    return fig1, fig2, analysis
+def withScriptContext(func):
+    '''
+    Wraps func so that it runs with the current Streamlit script context when called from a worker thread
+    '''
+    ctx = get_script_run_ctx()
 
-# Function to create a download link
-@st.cache_data(show_spinner=False)
-def create_download_link(html_content, filename):
-    b64 = base64.b64encode(html_content.encode()).decode()  # B64 encode
-    href = f'<a href="data:text/html;base64,{b64}" download="{filename}">Download this report</a>'
-    return href
+    def run(*args, **kwargs):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args, **kwargs)
+    return run
+
+@st.cache_resource(show_spinner=False)
+def getStageExecutor():
+    '''
+    Threads for the chart and analysis stages. asyncio.run does not wait for these, so a stage that misses its
+    deadline is left to finish (and fill the caches) in the background instead of holding up the page.
+    '''
+    return concurrent.futures.ThreadPoolExecutor(max_workers=performance_settings["stage_workers"],
+                                                 thread_name_prefix="analysis-stage")
+
+def runInStageThread(func, *args):
+    return asyncio.get_running_loop().run_in_executor(getStageExecutor(), withScriptContext(func), *args)
+
+def drawCharts(placeholder, fig1, fig2, caption=None):
+    with placeholder.container():
+        if caption:
+            st.caption(caption)
+        st.plotly_chart(fig1, theme="streamlit", use_container_width=True)
+        st.plotly_chart(fig2, theme="streamlit", use_container_width=True)
+
+async def renderCharts(placeholder, businessQuestion, results):
+    # Rule-based charts go up first; the LLM's charts replace them when they arrive, and they stay if it fails
+    quick1 = quick2 = None
+    if performance_settings["chart_rules_enabled"]:
+        try:
+            quick1, quick2 = chartRules.recommendCharts(results)
+        except Exception as e:
+            print(f"Rule-based charts failed with error: {repr(e)}")
+    if quick1 is not None:
+        simple = isinstance(results, pd.DataFrame) and \
+            len(results.columns) <= performance_settings["chart_rules_final_max_columns"] and \
+            all(trace.type != "table" for trace in quick1.data)
+        if simple:
+            drawCharts(placeholder, quick1, quick2)
+            return quick1, quick2
+        drawCharts(placeholder, quick1, quick2, caption="Quick view. Drawing charts tailored to the question...")
+
+    timeout = performance_settings["chart_deadline_seconds"]
+    try:
+        fig1, fig2 = await asyncio.wait_for(
+            runInStageThread(createChartsWithRetries, businessQuestion, results, time.monotonic() + timeout), timeout)
+    except asyncio.TimeoutError:
+        print(f"Charts missed their {timeout}s deadline")
+        fig1 = fig2 = None
+    if fig1 is not None and fig2 is not None:
+        drawCharts(placeholder, fig1, fig2)
+        return fig1, fig2
+    if quick1 is not None:
+        drawCharts(placeholder, quick1, quick2)
+        return quick1, quick2
+    placeholder.write("I was unable to plot the data.")
+    return None, None
+
+async def renderBusinessAnalysis(placeholder, prompt):
+    # Tokens are produced on a worker thread and handed to the event loop, which owns the page
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        if not stop.is_set():
+            try:
+                loop.call_soon_threadsafe(tokens.put_nowait, item)
+            except RuntimeError:  # The page moved on and closed the event loop
+                stop.set()
+
+    def produce():
+        # After the deadline the stream is still read to the end, without posting, so its response is cached
+        try:
+            for token in streamBusinessAnalysis(prompt):
+                put(token)
+        except Exception as e:
+            put(e)
+        put(done)
+
+    producer = asyncio.ensure_future(runInStageThread(produce))
+    timeout = performance_settings["analysis_deadline_seconds"]
+    deadline = loop.time() + timeout
+    analysis = ""
+    last_render = 0.0
+    try:
+        while (token := await asyncio.wait_for(tokens.get(), max(0.0, deadline - loop.time()))) is not done:
+            if isinstance(token, Exception):
+                raise token
+            analysis += token
+            # Throttle redraws so a fast stream doesn't flood the websocket
+            if time.perf_counter() - last_render > 0.05:
+                placeholder.markdown(analysis.replace("$", "\\$"))
+                last_render = time.perf_counter()
+        placeholder.markdown(analysis.replace("$", "\\$"))
+    except asyncio.TimeoutError:
+        # Leave the producer to finish (and cache the analysis) in the background; whatever arrived so far is kept
+        stop.set()
+        print(f"Business analysis missed its {timeout}s deadline")
+        if analysis:
+            analysis += f"\n\n*(The analysis was cut short after {timeout} seconds.)*"
+            placeholder.markdown(analysis.replace("$", "\\$"))
+        else:
+            placeholder.write("The analysis is taking too long. Please try again in a moment.")
+            analysis = None
+        return analysis
+    except Exception as e:
+        print(f"Business analysis failed with error: {repr(e)}")
+        placeholder.write("I am unable to provide the analysis. Please rephrase the question and try again.")
+        analysis = None
+    await producer
+    return analysis
+
+# Function that creates the charts and business analysis. Both stages run concurrently, each renders as soon as it is ready
+# and each has its own deadline, so neither can hold up or repeat the other.
+async def createChartsAndBusinessAnalysis(businessQuestion, results, prompt):
+    charts_placeholder = st.expander(label="Charts", expanded=True).empty()
+    analysis_placeholder = st.expander(label="Business Analysis", expanded=True).empty()
+    charts_placeholder.caption("Drawing charts...")
+    analysis_placeholder.caption("Writing analysis...")
+
+    (fig1, fig2), analysis = await asyncio.gather(
+        renderCharts(charts_placeholder, businessQuestion, results),
+        renderBusinessAnalysis(analysis_placeholder, buildDeploymentPrompt("business_analysis", [
+            promptSection(None, prompt, priority=2),
+            promptSection("Results", results, priority=1),
+        ])),
+    )
+    return fig1, fig2, analysis
 
 @st.cache_data(show_spinner=False)
 def read_svg(file_path):
     with open(file_path, 'r') as file:
         return file.read()
-@st.cache_data(show_spinner=False)
-def read_svg_as_base64(file_path):
-    with open(file_path, 'rb') as file:
-        return base64.b64encode(file.read()).decode('utf-8')
 
-# Callback function to generate HTML content
-@st.cache_data(show_spinner=False)
+def svgDataUri(svg):
+    # URL-encoded rather than base64, so the report stays compressible
+    return "data:image/svg+xml;charset=utf-8," + urllib.parse.quote(svg)
+
+def pruneReports(report_dir, max_age):
+    cutoff = time.time() - max_age
+    for entry in os.scandir(report_dir):
+        try:
+            if entry.name.startswith("report-") and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:  # Removed by another session
+            pass
+
 def generate_html_report(businessQuestion, sqlcode, results, fig1, fig2, analysis, datarobot_logo_svg, transformco_logo_svg):
-    plotly_html1 = pio.to_html(fig1, full_html=False, include_plotlyjs=True, default_width="100%",
-                               default_height="100%")
-    plotly_html2 = pio.to_html(fig2, full_html=False, include_plotlyjs=True, default_width="100%",
-                               default_height="100%")
+    '''
+    Writes the report to a temporary HTML file, piece by piece, and returns its path. plotly.js is included
+    once, from the CDN unless report_plotlyjs says otherwise, and the results table stops at report_max_rows rows.
+    '''
+    report_dir = performance_settings["report_dir"]
+    os.makedirs(report_dir, exist_ok=True)
+    pruneReports(report_dir, performance_settings["report_ttl"])
+
+    # Only the first chart carries plotly.js
+    figures = [fig for fig in (fig1, fig2) if fig is not None]
+    charts_html = "".join(
+        "<div>" + pio.to_html(fig, full_html=False, default_width="100%", default_height="100%",
+                              include_plotlyjs=performance_settings["report_plotlyjs"] if i == 0 else False) + "</div>"
+        for i, fig in enumerate(figures)) or "<p>I was unable to plot the data.</p>"
 
     # Convert markdown to HTML for the analysis section
-    analysis_html = markdown.markdown(analysis)
+    analysis_html = markdown.markdown(analysis or "")
 
-    html_content = f"""
+    max_rows = performance_settings["report_max_rows"]
+    total_rows = max(results.attrs.get("fetch", {}).get("total_rows") or 0, len(results))
+    results_note = f"<p>Showing the first {min(max_rows, len(results)):,} of {total_rows:,} rows.</p>" \
+        if total_rows > max_rows else ""
+
+    header = f"""
     <html>
     <head>
         <link rel="stylesheet" href="https://fonts.googleapis.com/css2?family=IBM+Plex+Sans:wght@400;700&family=IBM+Plex+Mono:wght@400;700&display=swap">
@@ -710,8 +2449,8 @@ def generate_html_report(businessQuestion, sqlcode, results, fig1, fig2, analysi
     </head>
     <body>
         <div class="logo-container">
-            <img src="data:image/svg+xml;base64,{datarobot_logo_svg}" class="logo-datarobot" alt="DataRobot Logo">
-            <img src="data:image/svg+xml;base64,{transformco_logo_svg}" class="logo-transformco" alt="TransformCo Logo">
+            <img src="{svgDataUri(datarobot_logo_svg)}" class="logo-datarobot" alt="DataRobot Logo">
+            <img src="{svgDataUri(transformco_logo_svg)}" class="logo-transformco" alt="TransformCo Logo">
         </div>
         <h1 class="report-title">AI Data Analyst Report</h1>
         <hr class="horizontal-rule">
@@ -727,13 +2466,14 @@ def generate_html_report(businessQuestion, sqlcode, results, fig1, fig2, analysi
         <hr class="horizontal-rule">
         <button type="button" class="collapsible">Results</button>
         <div class="content">
-            {results.to_html(index=False, escape=False)}
+            {results_note}
+    """
+    footer = f"""
         </div>
         <hr class="horizontal-rule">
         <button type="button" class="collapsible active">Charts</button>
         <div class="content show">
-            <div>{plotly_html1}</div>
-            <div>{plotly_html2}</div>
+            {charts_html}
         </div>
         <hr class="horizontal-rule">
         <button type="button" class="collapsible active">Business Analysis</button>
@@ -759,43 +2499,66 @@ def generate_html_report(businessQuestion, sqlcode, results, fig1, fig2, analysi
     </body>
     </html>
     """
-    return html_content
+    with tempfile.NamedTemporaryFile("w", encoding="utf-8", prefix="report-", suffix=".html", dir=report_dir,
+                                     delete=False) as file:
+        file.write(header)
+        file.write(results.head(max_rows).to_html(index=False, escape=False))
+        file.write(footer)
+    return file.name
+
+def sampleAndProfileTable(sampleSize, table, refresh=False):
+    results = getTableSample(sampleSize=sampleSize, table=table, refresh=refresh)
+    return results, get_top_frequent_values(results)
 
-@st.cache_data(show_spinner=False)
 def process_tables(dictionary, selectedTables, sampleSize):
-    tableSamples = []
-    tableDescriptions = []
-    frequentValues = pd.DataFrame()
-
-    for table in selectedTables:
-        tableDescription = summarizeTable(dictionary, table)
-        results = getTableSample(sampleSize=sampleSize, table=table)
-        tableSamples.append(results)
-        tableDescriptions.append(tableDescription)
-        freqVals = get_top_frequent_values(results)
-        frequentValues = pd.concat([frequentValues, freqVals], axis=0)
+    '''
+    Profiles the selected tables concurrently: the LLM table summary and the sample (plus its frequent values)
+    of every table are fetched on a bounded thread pool, and progress is reported per table as they finish.
+    '''
+    tableDescriptions = {}
+    tableSamples = {}
+    frequentValues = {}
+    progress_placeholder = st.empty()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=performance_settings["table_profiler_workers"]) as executor:
+        futures = {}
+        for table in selectedTables:
+            futures[executor.submit(withScriptContext(summarizeTable), dictionary, table)] = ("description", table)
+            futures[executor.submit(withScriptContext(sampleAndProfileTable), sampleSize, table)] = ("sample", table)
+
+        finished_tables = 0
+        for future in concurrent.futures.as_completed(futures):
+            kind, table = futures[future]
+            if kind == "description":
+                tableDescriptions[table] = future.result()
+            else:
+                tableSamples[table], frequentValues[table] = future.result()
+            if table in tableDescriptions and table in tableSamples:
+                finished_tables += 1
+                progress_placeholder.progress(finished_tables / len(selectedTables),
+                                              text=f"Profiled {table} ({finished_tables} of {len(selectedTables)} tables)")
+
+    progress_placeholder.empty()
+
+    # Keep the selection order and concatenate the frequent values once
+    tableDescriptions = [tableDescriptions[table] for table in selectedTables]
+    tableSamples = [tableSamples[table] for table in selectedTables]
+    frequent_frames = [frequentValues[table] for table in selectedTables]
+    frequentValues = pd.concat(frequent_frames, axis=0) if frequent_frames else pd.DataFrame()
 
     smallTableSamples = []
     for table in tableSamples:
-        smallSample = table.sample(n=3)
+        # Seeded so the prompt (and everything cached on it) is stable across reruns
+        smallSample = table.sample(n=min(3, len(table)), random_state=0)
         smallTableSamples.append(smallSample)
 
     return tableDescriptions, tableSamples, smallTableSamples, frequentValues
 
 @st.cache_data(show_spinner=False)
 def getSnowflakeTables(user, _private_key, account, database, schema, warehouse):
-    # Establish the connection
-    conn = snowflake.connector.connect(
-        user=user,
-        private_key=_private_key,
-        account=account,
-        warehouse=warehouse,
-        database=database,
-        schema=schema,
-        role=role,
-        # Enable case sensitivity for identifiers
-        case_sensitive_identifier_quoting=True
-    )
+    # Check out a pooled connection. This also warms the pool before the first question is asked.
+    pool = getSnowflakePool(user, _private_key, account, warehouse, database, schema, role)
+    conn = pool.acquire()
 
     try:
         # # Create a cursor object
@@ -820,9 +2583,9 @@ def getSnowflakeTables(user, _private_key, account, database, schema, warehouse)
         return tables
 
     finally:
-        # Close the cursor and connection
+        # Close the cursor and return the connection to the pool
         # cursor.close()
-        conn.close()
+        pool.release(conn)
 
 # callback functions for the ask button / clear text button
 def text_input_enterKey():
@@ -832,29 +2595,61 @@ def clear_text():
     st.session_state["businessQuestion"] = ""
     st.session_state["askButton"] = False
 
+def chunkDictionaryColumns(df, frequent_values):
+    '''
+    Splits the columns of df into chunks for the dictionary maker and returns each chunk's prompt.
+    A chunk ends after a column whose name hashes to a boundary (about one in dictionary_chunk_columns), or earlier
+    when the next column would take it past dictionary_chunk_tokens. Boundaries depend only on the columns around
+    them, so adding or changing a column changes the prompt of its own chunk only and every other chunk is served
+    from the response cache.
+    '''
+    average_columns = performance_settings["dictionary_chunk_columns"]
+    max_tokens = performance_settings["dictionary_chunk_tokens"]
+    encoding = performance_settings["prompt_tokenizer_encoding"]
+    frequent_by_column = {}
+    if not frequent_values.empty:
+        frequent_by_column = {row['Non-numeric column name']: i for i, row in frequent_values.iterrows()}
+
+    def chunkPrompt(columns):
+        frequent_rows = [frequent_by_column[column] for column in columns if column in frequent_by_column]
+        return buildDeploymentPrompt("data_dictionary_maker", [
+            promptSection("First 10 Rows", df.loc[:, columns].head(10), priority=1, max_rows=None),
+            promptSection("Unique and Frequent Values of Categorical Data", frequent_values.loc[frequent_rows],
+                          priority=2, max_rows=None),
+        ])
+
+    chunks = []
+    columns = []
+    tokens = 0
+    for column in df.columns:
+        column_tokens = promptBuilder.countTokens(chunkPrompt([column]), encoding)
+        if columns and tokens + column_tokens > max_tokens:
+            chunks.append(columns)
+            columns, tokens = [], 0
+        columns.append(column)
+        tokens += column_tokens
+        if int(hashlib.sha1(str(column).encode()).hexdigest(), 16) % average_columns == 0:
+            chunks.append(columns)
+            columns, tokens = [], 0
+    if columns:
+        chunks.append(columns)
+    return [chunkPrompt(columns) for columns in chunks]
+
 def make_dictionary_chunks(df):
-    dictionary_chunks = []
-    chunk_size = 10
-    total_columns = len(df.columns)
     progress_placeholder = st.empty()
-
-    for start in range(0, total_columns, chunk_size):
-        current_chunk = start // chunk_size + 1
-        total_chunks = (total_columns + chunk_size - 1) // chunk_size
-        progress = current_chunk / total_chunks
-
-        with progress_placeholder.container():
-            st.progress(progress,
-                        text=f'Processing {chunk_size} columns at a time in chunks. Currently working on chunk {current_chunk} of {total_chunks}')
-
-        end = min(start + chunk_size, total_columns)
-        subset = df.iloc[:10, start:end]
-        data = "First 10 Rows: \n" + str(
-            subset) + "\n Unique and Frequent Values of Categorical Data: \n" + str(
-            get_top_frequent_values(df))
-
-        dictionary_chunk = getDataDictionary(data)
-        dictionary_chunks.append(dictionary_chunk)
+    prompts = chunkDictionaryColumns(df, get_top_frequent_values(df))
+    total_chunks = len(prompts)
+    dictionary_chunks = [None] * total_chunks
+
+    # Chunks are described concurrently; the progress bar moves as each one finishes
+    with concurrent.futures.ThreadPoolExecutor(max_workers=performance_settings["dictionary_workers"]) as executor:
+        futures = {executor.submit(withScriptContext(getDataDictionary), prompt): i
+                   for i, prompt in enumerate(prompts)}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            dictionary_chunks[futures[future]] = future.result()
+            progress_placeholder.progress(
+                done / total_chunks,
+                text=f'Describing {len(df.columns)} columns in {total_chunks} chunks. {done} of {total_chunks} done')
 
     progress_placeholder.empty()
     return dictionary_chunks
@@ -892,6 +2687,37 @@ def setup_sidebar():
                                                                accept_multiple_files=False)
         process_csv_upload()
 
+        display_performance_stats()
+
+
+def display_performance_stats():
+    with st.expander(label="Performance", expanded=False):
+        st.caption("LLM deployments")
+        st.dataframe(getDeploymentStatsFrame(), hide_index=True)
+        st.caption("Snowflake pools")
+        st.dataframe(pd.DataFrame([
+            getSnowflakePool(user, st.session_state["private_key"], account, warehouse, database, schema,
+                             role).statsRow(),
+            getSnowparkPool(user, st.session_state["private_key"], account, warehouse, database, schema,
+                            role).statsRow(),
+        ]), hide_index=True)
+        if performance_settings["query_router_enabled"]:
+            st.caption("Query routing")
+            st.dataframe(pd.DataFrame([getQueryRouter().statsRow()]), hide_index=True)
+        if performance_settings["query_cache_enabled"]:
+            st.caption("Query result cache")
+            st.dataframe(pd.DataFrame([getQueryResultCache().statsRow()]), hide_index=True)
+        st.caption("Dataset store")
+        st.dataframe(pd.DataFrame([getDatasetStore().statsRow()]), hide_index=True)
+        if performance_settings["warmup_enabled"]:
+            st.caption("Cache warm-up")
+            st.dataframe(pd.DataFrame([startWarmup().statsRow()]), hide_index=True)
+        if performance_settings["sandbox_enabled"]:
+            st.caption("Code sandbox")
+            st.dataframe(pd.DataFrame([getCodeSandbox().statsRow()]), hide_index=True)
+        st.caption("Compiled code cache")
+        st.dataframe(pd.DataFrame([getCompiledCodeCache().statsRow()]), hide_index=True)
+
 
 def load_snowflake_tables():
     try:
@@ -917,6 +2743,88 @@ def display_logo_header():
     st.header("Ask a question about the data.")
 
 
+def warmTableSelection(tables):
+    '''
+    Computes the descriptions, suggested questions and table summaries get_data_definitions_and_suggestions needs
+    for a selection of tables into the shared caches. Everything is fetched again rather than read from the
+    caches, so each run replaces what the last one stored. Samples are per table, see warmTableSample.
+    '''
+    tables = list(tables)
+    loadSnowflakeTableSchemas.clear(tables, user, private_key, account, warehouse, database, schema)
+    describeSnowflakeTables.clear(tables, user, private_key, account, warehouse, database, schema)
+    dictionary = getSnowflakeTableDescriptions(tables, user, private_key, account, warehouse, database, schema)
+    if dictionary is None:
+        raise ConnectionError("Snowflake could not be reached")
+    suggestQuestion(dictionary, refresh=True)
+    for table in tables:
+        summarizeTable(dictionary, table, refresh=True)
+
+def warmTableSample(table):
+    sampleAndProfileTable(performance_settings["table_sample_size"], table, refresh=True)
+
+
+class WarmupJob:
+    '''
+    Background thread that warms the caches for every configured table, and every combination of up to max_tables
+    of them in configuration order (the order the sidebar selects them in), at start-up and then every interval
+    seconds. warm_table runs once per table and run, warm once per selection.
+    '''
+
+    def __init__(self, tables, warm, max_tables, workers, interval, warm_table=None):
+        self.tables = list(tables)
+        self.selections = [combination for size in range(1, min(max_tables, len(tables)) + 1)
+                           for combination in itertools.combinations(tables, size)]
+        self.warm = warm
+        self.warm_table = warm_table
+        self.workers = workers
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.stats = {"selections": len(self.selections), "runs": 0, "warmed": 0, "failures": 0,
+                      "last_run_seconds": None, "last_finished": None}
+        self._thread = threading.Thread(target=self._loop, name="cache-warmup", daemon=True)
+        self._thread.start()
+
+    def _warm(self, warm, item, label):
+        try:
+            warm(item)
+            outcome = "warmed"
+        except Exception as e:
+            print(f"Warm-up of {label} failed: {e}")
+            outcome = "failures"
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def runOnce(self):
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if self.warm_table is not None:
+                list(executor.map(lambda table: self._warm(self.warm_table, table, table), self.tables))
+            list(executor.map(lambda selection: self._warm(self.warm, selection, ", ".join(selection)),
+                              self.selections))
+        with self._lock:
+            self.stats["runs"] += 1
+            self.stats["last_run_seconds"] = round(time.perf_counter() - start, 1)
+            self.stats["last_finished"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def _loop(self):
+        while True:
+            self.runOnce()
+            time.sleep(self.interval)
+
+    def statsRow(self):
+        with self._lock:
+            return dict(self.stats)
+
+
+@st.cache_resource(show_spinner=False)
+def startWarmup():
+    # The warm-up threads call cached functions, so they run with the context of the script that started them
+    return WarmupJob(list(st.secrets.snowflake_credentials.tables.values()), withScriptContext(warmTableSelection),
+                     max_tables=performance_settings["warmup_max_tables"],
+                     workers=performance_settings["warmup_workers"],
+                     interval=performance_settings["warmup_interval"],
+                     warm_table=withScriptContext(warmTableSample))
+
 def get_data_definitions_and_suggestions():
     with st.spinner("Getting table definitions..."):
         dictionary = getSnowflakeTableDescriptions(
@@ -927,7 +2835,7 @@ def get_data_definitions_and_suggestions():
         table_descriptions, table_samples, small_table_samples, frequent_values = process_tables(
             dictionary,
             st.session_state['selectedTables'],
-            sampleSize=1000)
+            sampleSize=performance_settings["table_sample_size"])
         st.session_state.update({
             "tableDescriptions": table_descriptions,
             "tableSamples": table_samples,
@@ -960,111 +2868,189 @@ def display_explore_tab(tab):
             st.write(st.session_state["tableSamples"][i])
             display_data_dictionary(i)
 
-def get_column_definitions_from_secoda(table_id: str, api_key: str) -> list[dict[str, str]]:
-    """Retrieves a list of columns associated with a given table_id"""
-    # Setup Query
-    headers = {"Authorization": f"Bearer {api_key}"}
-    filters = {
-        "operator": "and",
-        "operands": [
-            {
-                "operator": "or",
-                "operands": [
-                    {
-                        "operands": [],
-                        "field": "native_type",
-                        "operator": "exact",
-                        "value": "column",
-                    }
-                ],
-            },
-            {
-                "operator": "or",
-                "operands": [
-                    {
-                        "operands": [],
-                        "field": "parent_id",
-                        "operator": "exact",
-                        "value": table_id,
-                    }
-                ],
-            },
-        ],
-    }
+class SecodaClient:
+    '''
+    Secoda catalog client with a pooled keep-alive session. Every GET is cached in the cache database: within ttl
+    seconds the stored body is returned without a request, after that it is revalidated with its ETag, and it is
+    also served when Secoda can't be reached. When a listing reports its page count, the remaining pages are
+    fetched concurrently.
+    '''
 
-    # Initial query
-    resp = requests.get(
-        f"{st.secrets.secoda.SECODA_API_ENDPOINT}/resource/catalog",
-        headers=headers,
-        params={"filter": json.dumps(filters)},
-    )
-    resp.raise_for_status()
-
-    # Grab the paginated data (as long as links/next is not None, there's more to get)
-    js = resp.json()
-    results: list[dict] = js["results"]
-    while js["links"]["next"] is not None:
-        resp = requests.get(js["links"]["next"], headers=headers)
-        js = resp.json()
-        results.extend(js["results"])
-
-    # Cleanup
-    cleaned_results = []
-    for result in results:
-        result = {
-            k: v
-            for k, v in result.items()
-            if k in {"title_cased", "description", "properties", "type"}
+    def __init__(self, endpoint, api_key, database, ttl, timeout, page_workers, table_ids=None,
+                 default_table_id=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.database = database
+        self.ttl = ttl
+        self.timeout = timeout
+        self.page_workers = page_workers
+        self.table_ids = dict(table_ids or {})
+        self.default_table_id = default_table_id
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=page_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Authorization": f"Bearer {api_key}"})
+        database.executescript("""
+            CREATE TABLE IF NOT EXISTS secoda_responses (
+                key TEXT PRIMARY KEY,
+                etag TEXT,
+                body TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            );
+            """)
+
+    def get(self, url, params=None):
+        key = url + "?" + json.dumps(params or {}, sort_keys=True)
+        rows = self.database.execute("SELECT etag, body, fetched_at FROM secoda_responses WHERE key = ?", (key,))
+        etag, body, fetched_at = rows[0] if rows else (None, None, 0)
+        if body is not None and time.time() - fetched_at < self.ttl:
+            return json.loads(body)
+
+        headers = {"If-None-Match": etag} if etag else {}
+        try:
+            resp = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            if resp.status_code == 304 and body is not None:
+                self.database.execute("UPDATE secoda_responses SET fetched_at = ? WHERE key = ?", (time.time(), key))
+                return json.loads(body)
+            resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            if body is None:
+                raise
+            print(f"Secoda request failed, using the cached response: {e}")
+            return json.loads(body)
+
+        self.database.execute("INSERT OR REPLACE INTO secoda_responses VALUES (?, ?, ?, ?)",
+                              (key, resp.headers.get("ETag"), resp.text, time.time()))
+        return resp.json()
+
+    def catalog(self, filters):
+        '''
+        Every catalog resource matching filters, across all pages
+        '''
+        url = f"{self.endpoint}/resource/catalog"
+        params = {"filter": json.dumps(filters)}
+        js = self.get(url, params)
+        results = list(js["results"])
+        total_pages = js.get("total_pages") or js.get("meta", {}).get("total_pages")
+        if total_pages and total_pages > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.page_workers) as executor:
+                pages = executor.map(lambda page: self.get(url, {**params, "page": page}), range(2, total_pages + 1))
+                for page in pages:
+                    results.extend(page["results"])
+            return results
+
+        # Unknown page count: follow the next links one at a time
+        while js["links"]["next"] is not None:
+            js = self.get(js["links"]["next"])
+            results.extend(js["results"])
+        return results
+
+    @staticmethod
+    def exactFilters(**fields):
+        return {
+            "operator": "and",
+            "operands": [
+                {"operator": "or", "operands": [{"operands": [], "field": field, "operator": "exact", "value": value}]}
+                for field, value in fields.items()
+            ],
         }
-        # Flatten properties
-        result["ai_hint"] = result["properties"]["custom"]["AI_Hints"]
 
-        # Create new structure with renamed fields
-        cleaned_result = {
+    def tableId(self, table):
+        '''
+        The Secoda ID of a table: from the configured TABLE_IDS mapping, else looked up by name in the catalog,
+        else the configured default, if any (None otherwise)
+        '''
+        if table in self.table_ids:
+            return self.table_ids[table]
+        try:
+            matches = self.catalog(self.exactFilters(native_type="table", title=table))
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            print(f"Could not look up the Secoda ID of {table}: {e}")
+            matches = []
+        if matches and matches[0].get("id"):
+            return matches[0]["id"]
+        return self.default_table_id
+
+    def columnDefinitions(self, table_id):
+        '''
+        The columns of a table in the catalog, with their descriptions and AI hints; none when table_id is None
+        '''
+        if table_id is None:
+            return []
+        results = self.catalog(self.exactFilters(native_type="column", parent_id=table_id))
+        return [{
             "Column Name": result["title_cased"],
-            "ai_hint": result["ai_hint"],
+            "ai_hint": result["properties"]["custom"]["AI_Hints"],
             "description": result["description"],
-        }
+        } for result in results]
 
-        cleaned_results.append(cleaned_result)
 
-    return cleaned_results
+@st.cache_resource(show_spinner=False)
+def getSecodaClient():
+    return SecodaClient(secoda_api_endpoint, secoda_api_key, getCacheDatabase(),
+                        ttl=performance_settings["secoda_cache_ttl"], timeout=performance_settings["secoda_timeout"],
+                        page_workers=performance_settings["secoda_page_workers"],
+                        table_ids=st.secrets.secoda.get("TABLE_IDS", {}),
+                        default_table_id=st.secrets.secoda.get("DEFAULT_TABLE_ID"))
+
+@st.cache_resource(show_spinner=False)
+def startSecodaPrefetch():
+    '''
+    Warms the Secoda cache for every configured table on a background thread, once per process
+    '''
+    client = getSecodaClient()
+    tables = list(st.secrets.snowflake_credentials.tables.values())
+
+    def prefetch():
+        for table in tables:
+            try:
+                client.columnDefinitions(client.tableId(table))
+            except Exception as e:
+                print(f"Could not prefetch Secoda definitions for {table}: {e}")
+
+    thread = threading.Thread(target=prefetch, name="secoda-prefetch", daemon=True)
+    thread.start()
+    return thread
+
+def get_column_definitions_from_secoda(table: str) -> list[dict[str, str]]:
+    """Retrieves a list of columns associated with a given table"""
+    client = getSecodaClient()
+    try:
+        return client.columnDefinitions(client.tableId(table))
+    except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+        print(f"Could not get Secoda definitions for {table}: {e}")
+        return []
+
 def display_data_dictionary(index):
     table_name = st.session_state['selectedTables'][index]
     dictionary_key = f'{table_name}_dictionary'
 
     if dictionary_key not in st.session_state:
-        with st.expander(label=f"Data Dictionary for {table_name}", expanded=False):
-            # Commented out. Replacing with Secoda
-            # with st.spinner("Making dictionary..."):
-            #     dictionary_chunks = make_dictionary_chunks(st.session_state["tableSamples"][index])
-            # with st.spinner("Putting it all together..."):
-            #     assembled_dictionary = assembleDictionaryParts(dictionary_chunks)
-            #     st.session_state[dictionary_key] = assembled_dictionary
-            #
-            #     # Initialize or append to llm_generated_dictionary
-            #     if 'llm_generated_dictionary' not in st.session_state:
-            #         st.session_state['llm_generated_dictionary'] = assembled_dictionary
-            #     else:
-            #         st.session_state['llm_generated_dictionary'] += "\n" + assembled_dictionary
-            with st.spinner("Getting dictionary from Secoda..."):
-                secoda_dictionary = get_column_definitions_from_secoda("e7317c24-f56b-40b2-abb7-50d7974ee4f0", api_key=secoda_api_key)
-                st.session_state['llm_generated_dictionary'] = secoda_dictionary
-            st.markdown(secoda_dictionary)
-    else:
-        with st.expander(label=f"Data Dictionary for {table_name}", expanded=False):
-            st.markdown(st.session_state[dictionary_key])
+        with st.spinner(f"Updating the data dictionary for {table_name}..."):
+            st.session_state[dictionary_key] = formatTableDictionary(table_name, getTableDictionary(
+                table_name, st.session_state["private_key"], st.session_state["tableSamples"][index],
+                selection=st.session_state['selectedTables']))
+    with st.expander(label=f"Data Dictionary for {table_name}", expanded=False):
+        st.markdown(st.session_state[dictionary_key])
+
+    secoda_key = f'{table_name}_secoda_dictionary'
+    if secoda_key not in st.session_state:
+        with st.spinner("Getting dictionary from Secoda..."):
+            st.session_state[secoda_key] = get_column_definitions_from_secoda(table_name)
+    if st.session_state[secoda_key]:
+        with st.expander(label=f"Secoda Definitions for {table_name}", expanded=False):
+            st.dataframe(pd.DataFrame(st.session_state[secoda_key]), use_container_width=True)
 
 
 def display_csv_explore_tab(tab):
     with tab:
-        st.session_state["df"] = pd.read_csv(st.session_state["selectedCSVFile"])
+        st.session_state["df"] = loadUploadedCSV(st.session_state["selectedCSVFile"])
         with st.expander(label="First 10 Rows", expanded=False):
             st.dataframe(st.session_state["df"].head(10))
 
         try:
             with st.expander(label="Column Descriptions", expanded=False):
-                st.dataframe(st.session_state["df"].describe(include='all'))
+                st.dataframe(getDataProfile(st.session_state["df"]))
         except:
             pass
 
@@ -1149,17 +3135,19 @@ def analyze_question_csv():
 
 
 def generate_prompt():
-    # Ensure the llm_generated_dictionary is not None or empty
-    full_dictionary = st.session_state.get('llm_generated_dictionary', '')
-
-    # Build the prompt
-    prompt = (
-        f"Business Question: {st.session_state.get('businessQuestion', '')}\n"
-        f"Data Dictionary: \n{full_dictionary}\n"
-        f"Column Definitions: \n{st.session_state.get('tableDescriptions', '')}\n"
-        f"Data Sample: \n{st.session_state.get('smallTableSamples', '')}\n"
-        f"Frequent Values: \n{st.session_state.get('frequentValues', '')}"
-    )
+    # Stored dictionaries of the selected tables, then their Secoda column definitions
+    selected_tables = st.session_state.get("selectedTables", [])
+    full_dictionary = [st.session_state.get(f"{table}_dictionary") for table in selected_tables]
+    full_dictionary.extend(st.session_state.get(f"{table}_secoda_dictionary") or None for table in selected_tables)
+
+    # Build the prompt, cutting samples first and column definitions last when it is too long
+    prompt = buildDeploymentPrompt("sql_code_generator", [
+        promptSection("Business Question", st.session_state.get('businessQuestion', ''), required=True),
+        promptSection("Data Dictionary", full_dictionary, priority=3),
+        promptSection("Column Definitions", st.session_state.get('tableDescriptions', []), priority=4),
+        promptSection("Data Sample", st.session_state.get('smallTableSamples', []), priority=1),
+        promptSection("Frequent Values", st.session_state.get('frequentValues'), priority=2, max_rows=None),
+    ])
 
     # Debugging output
     print("\n ================= \n PROMPT \n =================")
@@ -1169,29 +3157,63 @@ def generate_prompt():
 
 
 def generate_csv_prompt():
-    return ("Business Question: " + str(st.session_state["businessQuestion"]) +
-            "\n Data Sample: \n" + str(st.session_state["df"].head(3)) +
-            "\n Unique and Frequent Values of Categorical Data: \n" + str(
-                get_top_frequent_values(st.session_state["df"])) +
-            "\n Data Dictionary: \n" + str(st.session_state["dictionary"]))
+    return buildDeploymentPrompt("python_code_generator", [
+        promptSection("Business Question", str(st.session_state["businessQuestion"]), required=True),
+        promptSection("Data Sample", st.session_state["df"].head(3), priority=1),
+        promptSection("Unique and Frequent Values of Categorical Data",
+                      get_top_frequent_values(st.session_state["df"]), priority=2, max_rows=None),
+        promptSection("Data Dictionary", st.session_state["dictionary"], priority=3),
+    ])
 
 
+def queryTag(attempt):
+    '''
+    Identifies a generated query in QUERY_TAG: the browser session, the question and the attempt at it
+    '''
+    ctx = get_script_run_ctx()
+    return {
+        "session": ctx.session_id if ctx else None,
+        "question": hashlib.sha1(str(st.session_state["businessQuestion"]).encode()).hexdigest()[:12],
+        "attempt": attempt,
+    }
+
 def execute_query_with_retries(csv_mode):
     attempts = 0
     max_retries = 5
+    if not csv_mode and performance_settings["sql_speculative_candidates"] > 1:
+        try:
+            sql, results = executeSpeculativeQuery(st.session_state["prompt"], database, schema, tag=queryTag(1))
+        except Exception as e:
+            # Fall through to the serial retries, which start from the unchanged prompt
+            print(f"Speculative SQL failed: {e}")
+            sql, results = None, None
+        if sql is not None:
+            st.session_state["sqlCode"], st.session_state["results"] = sql, results
+            return
+        if results is not None:
+            # Every candidate failed: their errors become the first attempt's feedback for the serial retries
+            attempts = 1
+            for candidate in results:
+                if candidate["error"] is not None:
+                    st.session_state[
+                        "prompt"] += f"\nQUERY FAILED! Attempt {attempts} failed with error: {repr(candidate['error'])}\nCode: {candidate['sql']}"
     while attempts < max_retries:
         st.session_state["sqlCode"] = None
         try:
             if csv_mode:
                 st.session_state["sqlCode"], st.session_state["results"] = executePythonCode(st.session_state["prompt"], st.session_state["df"])
             else:
-                st.session_state["sqlCode"], st.session_state["results"] = execute_sql_to_python_analysis(st.session_state["prompt"], user, st.session_state["private_key"], account, warehouse, database, schema)
+                st.session_state["sqlCode"], st.session_state["results"] = executeSnowflakeQuery(st.session_state["prompt"], user, st.session_state["private_key"], account, warehouse, database, schema, tag=queryTag(attempts + 1))
                 # st.session_state["sqlCode"], st.session_state["results"] = executeSnowflakeSnowpark(st.session_state["prompt"], user, st.session_state["password"], account, warehouse, database, schema)
+            if st.session_state["results"] is None:
+                raise ValueError("The query failed to run, retrying...")
             if st.session_state["results"].empty:
                 raise ValueError("The DataFrame is empty, retrying...")
             break
         except Exception as e:
             attempts += 1
+            # Rejected SQL never reaches the return value, so take the statement from the error
+            st.session_state["sqlCode"] = getattr(e, "sql", st.session_state["sqlCode"])
             st.session_state[
                 "prompt"] += f"\nQUERY FAILED! Attempt {attempts} failed with error: {repr(e)}\nCode: {st.session_state['sqlCode']}"
             if attempts == max_retries:
@@ -1201,15 +3223,22 @@ def display_query_results():
     with st.expander(label="Code", expanded=False):
         st.code(st.session_state["sqlCode"], language="sql")
     with st.expander(label="Result", expanded=True):
-        st.table(st.session_state["results"])
+        results = st.session_state["results"]
+        if len(results) > performance_settings["results_static_table_rows"]:
+            st.dataframe(results, use_container_width=True)
+        else:
+            st.table(results)
+        truncation = describeTruncation(results)
+        if truncation:
+            st.caption(truncation)
 
 
 def analyze_and_generate_report(full_dictionary):
     with st.spinner("Visualization and analysis in progress..."):
         st.session_state["fig1"], st.session_state["fig2"], st.session_state[
-            "analysis"] = createChartsAndBusinessAnalysis(
+            "analysis"] = asyncio.run(createChartsAndBusinessAnalysis(
             st.session_state["businessQuestion"],
-            st.session_state["results"], st.session_state["prompt"])
+            st.session_state["results"], st.session_state["prompt"]))
 
     generate_report(full_dictionary)
 
@@ -1217,42 +3246,44 @@ def analyze_and_generate_report(full_dictionary):
 def analyze_and_generate_report_csv():
     with st.spinner("Visualization and analysis in progress..."):
         st.session_state["fig1"], st.session_state["fig2"], st.session_state[
-            "analysis"] = createChartsAndBusinessAnalysis(
+            "analysis"] = asyncio.run(createChartsAndBusinessAnalysis(
             st.session_state["businessQuestion"],
-            st.session_state["results"], st.session_state["prompt"])
+            st.session_state["results"], st.session_state["prompt"]))
 
     generate_report_csv()
 
 
 def generate_report(full_dictionary):
-    read_svgs_and_generate_html_report()
-    create_and_display_download_link()
+    display_report_download()
 
 
 def generate_report_csv():
-    read_svgs_and_generate_html_report()
-    create_and_display_download_link()
-
+    display_report_download()
 
-def read_svgs_and_generate_html_report():
-    st.session_state["datarobot_logo_svg"] = read_svg_as_base64("DataRobotLogo.svg")
-    st.session_state["transformco_logo_svg"] = read_svg_as_base64("transformCoLogo.svg")
 
-    st.session_state["html_content"] = generate_html_report(st.session_state["businessQuestion"],
-                                                            st.session_state["sqlCode"],
-                                                            st.session_state["results"], st.session_state["fig1"],
-                                                            st.session_state["fig2"],
-                                                            st.session_state["analysis"],
-                                                            st.session_state["datarobot_logo_svg"],
-                                                            st.session_state["transformco_logo_svg"])
+def display_report_download():
+    # Nothing is built until the button is clicked; the report is then written to a file and served from it
+    st.session_state["datarobot_logo_svg"] = read_svg("DataRobotLogo.svg")
+    st.session_state["transformco_logo_svg"] = read_svg("transformCoLogo.svg")
+    report_inputs = [st.session_state[key] for key in ("businessQuestion", "sqlCode", "results", "fig1", "fig2",
+                                                       "analysis", "datarobot_logo_svg", "transformco_logo_svg")]
 
+    def build_report():
+        with open(generate_html_report(*report_inputs), "rb") as file:
+            return file.read()
 
-def create_and_display_download_link():
-    st.session_state["download_link"] = create_download_link(st.session_state["html_content"], 'report.html')
-    st.markdown(st.session_state["download_link"], unsafe_allow_html=True)
+    st.download_button(label="Download this report", data=build_report, file_name="report.html", mime="text/html",
+                       on_click="ignore")
 
 
 def mainPage():
+    if performance_settings["sandbox_enabled"]:
+        getCodeSandbox()  # start warming the sandbox workers before the first question
+    if performance_settings["secoda_prefetch"]:
+        startSecodaPrefetch()
+    # Starts once per server process, after the first login, so tables are profiled before anyone selects them
+    if performance_settings["warmup_enabled"]:
+        startWarmup()
     setup_sidebar()
 
     display_logo_header()
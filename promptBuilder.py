@@ -0,0 +1,199 @@
+'''
+Assembles LLM prompts from labelled sections, shrinking the least important ones to fit a token budget
+'''
+import pandas as pd
+
+try:
+    import tiktoken
+except ImportError:  # Sizes are then estimated from the character count
+    tiktoken = None
+
+_encodings = {}
+
+
+def countTokens(text, encoding="cl100k_base"):
+    '''
+    Number of tokens in text, or an estimate of it when tiktoken is not installed
+    '''
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    if encoding not in _encodings:
+        try:
+            _encodings[encoding] = tiktoken.get_encoding(encoding)
+        except Exception:  # Unknown encoding, or its file can't be downloaded
+            _encodings[encoding] = None
+    if _encodings[encoding] is None:
+        return (len(text) + 3) // 4
+    return len(_encodings[encoding].encode(text, disallowed_special=()))
+
+
+def truncateText(text, max_tokens, encoding="cl100k_base"):
+    '''
+    The start of text, cut at a line boundary where possible, that fits in max_tokens
+    '''
+    if countTokens(text, encoding) <= max_tokens:
+        return text
+    marker = "\n[... truncated]"
+    keep = max(0, max_tokens - countTokens(marker, encoding))
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if countTokens(text[:middle], encoding) <= keep:
+            low = middle
+        else:
+            high = middle - 1
+    cut = text[:low]
+    if "\n" in cut[len(cut) // 2:]:
+        cut = cut[:cut.rindex("\n")]
+    return cut + marker
+
+
+def summarizeFrame(df):
+    '''
+    Compact summary statistics for every column of df: range and mean of numbers and dates, distinct values
+    and the most common value of everything else
+    '''
+    lines = []
+    for column in df.columns:
+        values = df[column]
+        nulls = int(values.isna().sum())
+        null_text = f", {nulls:,} null" if nulls else ""
+        if pd.api.types.is_bool_dtype(values):
+            lines.append(f"{column}: {int(values.sum()):,} true of {values.count():,}{null_text}")
+        elif pd.api.types.is_numeric_dtype(values):
+            if values.count():
+                lines.append(f"{column}: min {values.min():.6g}, mean {values.mean():.6g}, max {values.max():.6g}"
+                             f"{null_text}")
+        elif pd.api.types.is_datetime64_any_dtype(values):
+            if values.count():
+                lines.append(f"{column}: {values.min()} to {values.max()}{null_text}")
+        else:
+            try:
+                counts = values.value_counts()
+            except TypeError:  # Unhashable cells
+                counts = values.astype(str).value_counts()
+            if len(counts):
+                lines.append(f"{column}: {len(counts):,} distinct, most common {str(counts.index[0])[:60]!r} "
+                             f"({counts.iloc[0]:,}){null_text}")
+    return "\n".join(lines)
+
+
+def frameToText(df, max_rows=50, max_columns=40, total_rows=None):
+    '''
+    df as compact CSV: its first and last rows, then summary statistics when rows were left out. total_rows is
+    the size of the full result when df is a truncated fetch of it.
+    '''
+    if not isinstance(df, pd.DataFrame):
+        df = df.to_frame() if isinstance(df, pd.Series) else pd.DataFrame({"result": [df]})
+    rows, columns = df.shape
+    total_rows = max(total_rows or rows, rows)
+
+    header = f"({total_rows:,} rows x {columns:,} columns"
+    if total_rows > rows:
+        header += f"; only the first {rows:,} rows were fetched"
+    shown = df
+    if columns > max_columns:
+        shown = df.iloc[:, :max_columns]
+        header += f"; {columns - max_columns:,} more columns not shown: " + ", ".join(
+            str(column) for column in df.columns[max_columns:])
+    if rows > max_rows > 0:
+        header += f"; showing the first and last {max_rows:,} rows" if max_rows > 1 else "; showing the first row"
+    header += ")"
+    if not rows or not max_rows:
+        body = ""
+    elif rows > max_rows:
+        head = shown.head((max_rows + 1) // 2).to_csv(index=False, float_format="%.6g")
+        tail = shown.tail(max_rows // 2).to_csv(index=False, header=False, float_format="%.6g")
+        body = head + ("...\n" + tail if max_rows > 1 else "")
+    else:
+        body = shown.to_csv(index=False, float_format="%.6g")
+
+    text = header + ("\n" + body.rstrip("\n") if body else "")
+    if rows > max_rows or total_rows > rows:
+        summary = summarizeFrame(shown)
+        if summary:
+            text += "\nSummary statistics" + (" of the fetched rows" if total_rows > rows else "") + ":\n" + summary
+    return text
+
+
+class PromptSection:
+    '''
+    One labelled part of a prompt: text, a DataFrame or a list of either, left out when empty
+    '''
+
+    def __init__(self, label, content, priority=0, required=False, max_rows=50, max_columns=40):
+        self.label = label
+        self.content = content
+        self.priority = priority
+        self.required = required
+        self.max_rows = max_rows
+        self.max_columns = max_columns
+
+    def _items(self):
+        if self.content is None:
+            return []
+        items = self.content if isinstance(self.content, (list, tuple)) else [self.content]
+        return [item for item in items if item is not None and not (isinstance(item, pd.DataFrame) and item.empty)]
+
+    def _hasFrames(self):
+        return any(isinstance(item, (pd.DataFrame, pd.Series)) for item in self._items())
+
+    def render(self, level=0, encoding="cl100k_base", full_tokens=None):
+        '''
+        The section's text at a shrink level (0 is complete), or None once it has nothing left to show
+        '''
+        items = self._items()
+        if not items:
+            return None
+        if self._hasFrames():
+            # Halve the rows shown at every level, then show only the shape and statistics, then drop
+            limit = self.max_rows
+            if limit is None:
+                limit = max(len(item) for item in items if isinstance(item, (pd.DataFrame, pd.Series)))
+            if level > limit.bit_length():
+                return None
+            max_rows = limit >> level
+            parts = [frameToText(item, max_rows, self.max_columns,
+                                 total_rows=item.attrs.get("fetch", {}).get("total_rows"))
+                     if isinstance(item, pd.DataFrame) else
+                     frameToText(item, max_rows, self.max_columns) if isinstance(item, pd.Series) else str(item)
+                     for item in items]
+        else:
+            parts = [str(item) for item in items]
+        parts = [part for part in parts if part]
+        text = ("\n\n" if any("\n" in part for part in parts) else "\n").join(parts)
+        if not text:
+            return None
+        if not self._hasFrames() and level:
+            # Halve the text at every level, dropping it once it's under a few lines
+            max_tokens = (full_tokens or countTokens(text, encoding)) >> level
+            if max_tokens < 32:
+                return None
+            text = truncateText(text, max_tokens, encoding)
+        if not self.label:
+            return text
+        return f"{self.label}: \n{text}" if self._hasFrames() else f"{self.label}: {text}"
+
+
+def buildPrompt(sections, max_tokens, encoding="cl100k_base"):
+    '''
+    Joins the sections in order, shrinking the lowest-priority ones (and dropping them when they can't shrink
+    further) until the prompt fits in max_tokens or only required sections are left
+    '''
+    levels = [0] * len(sections)
+    full_tokens = [None] * len(sections)
+    texts = []
+    for i, section in enumerate(sections):
+        texts.append(section.render(0, encoding))
+        full_tokens[i] = countTokens(texts[i], encoding) if texts[i] else 0
+    sizes = [full_tokens[i] for i in range(len(sections))]
+
+    while sum(sizes) + len(sections) > max_tokens:
+        candidates = [i for i, section in enumerate(sections) if not section.required and texts[i] is not None]
+        if not candidates:
+            break
+        i = min(candidates, key=lambda i: (sections[i].priority, -i))
+        levels[i] += 1
+        texts[i] = sections[i].render(levels[i], encoding, full_tokens=full_tokens[i])
+        sizes[i] = countTokens(texts[i], encoding) if texts[i] else 0
+    return "\n".join(text for text in texts if text)
@@ -0,0 +1,38 @@
+'''
+Finds the tables a SQL statement reads from, using the sqlglot syntax tree
+'''
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+
+
+def identifierName(identifier):
+    # Unquoted identifiers resolve to upper case, quoted ones keep their case
+    return identifier.this if identifier.quoted else identifier.this.upper()
+
+
+def referencedTables(sql, database, schema, dialect="snowflake"):
+    '''
+    Sorted (database, schema, table) of every table sql reads from, leaving out CTEs and table functions; empty
+    when the SQL can't be parsed
+    '''
+    try:
+        statements = sqlglot.parse(sql, read=dialect)
+    except SqlglotError:
+        return []
+
+    tables = set()
+    for tree in statements:
+        if tree is None:
+            continue
+        ctes = {identifierName(cte.args["alias"].this) for cte in tree.find_all(exp.CTE)
+                if isinstance(cte.args.get("alias"), exp.TableAlias)}
+        for table in tree.find_all(exp.Table):
+            if not isinstance(table.this, exp.Identifier):
+                continue  # A table function, such as TABLE(FLATTEN(...))
+            parts = [identifierName(part) for part in table.parts if isinstance(part, exp.Identifier)]
+            if len(parts) == 1 and parts[0] in ctes:
+                continue
+            parts = [database.upper(), schema.upper()][:3 - len(parts)] + parts
+            tables.add(tuple(parts[-3:]))
+    return sorted(tables)
@@ -0,0 +1,46 @@
+import pytest
+
+from sqlTables import referencedTables
+
+
+def tables(sql):
+    return referencedTables(sql, "analytics", "public")
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM orders", ["ORDERS"]),
+    ("SELECT * FROM orders JOIN customers ON orders.customer_id = customers.id", ["CUSTOMERS", "ORDERS"]),
+    ("SELECT * FROM sales JOIN stores USING (store_id)", ["SALES", "STORES"]),
+    ("SELECT * FROM sales s LEFT JOIN stores st ON s.store_id = st.id INNER JOIN regions r ON st.region = r.id",
+     ["REGIONS", "SALES", "STORES"]),
+    ("SELECT * FROM orders o, customers AS c WHERE o.customer_id = c.id", ["CUSTOMERS", "ORDERS"]),
+    ("SELECT * FROM orders WHERE amount > 0", ["ORDERS"]),
+    ("SELECT EXTRACT(YEAR FROM order_date) AS y, COUNT(*) FROM orders GROUP BY 1", ["ORDERS"]),
+    ("SELECT * FROM (SELECT * FROM orders) sub JOIN customers ON sub.customer_id = customers.id",
+     ["CUSTOMERS", "ORDERS"]),
+])
+def test_tables_in_the_default_schema(sql, expected):
+    assert tables(sql) == [("ANALYTICS", "PUBLIC", name) for name in expected]
+
+
+def test_ctes_are_not_tables():
+    sql = """
+        WITH monthly AS (SELECT DATE_TRUNC('month', order_date) AS m, SUM(amount) AS total FROM orders GROUP BY 1),
+             ranked AS (SELECT * FROM monthly)
+        SELECT * FROM ranked JOIN targets ON ranked.m = targets.m
+    """
+    assert tables(sql) == [("ANALYTICS", "PUBLIC", "ORDERS"), ("ANALYTICS", "PUBLIC", "TARGETS")]
+
+
+def test_qualified_and_quoted_names():
+    sql = 'SELECT * FROM other.sales JOIN warehouse.raw."Events" e ON e.id = sales.id'
+    assert tables(sql) == [("ANALYTICS", "OTHER", "SALES"), ("WAREHOUSE", "RAW", "Events")]
+
+
+def test_table_functions_are_left_out():
+    sql = "SELECT f.value FROM orders, LATERAL FLATTEN(input => orders.items) f, TABLE(GENERATOR(ROWCOUNT => 3))"
+    assert tables(sql) == [("ANALYTICS", "PUBLIC", "ORDERS")]
+
+
+def test_unparseable_sql_has_no_tables():
+    assert tables("SELECT FROM WHERE (") == []